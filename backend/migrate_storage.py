@@ -0,0 +1,146 @@
+"""Online, resumable migration to the typed storage schema (native dates, enum codes).
+
+Tasks created before near-duplicate detection also get their MinHash
+signature and LSH bands backfilled, so their analyses can be reused
+(deployments that already finished the migration: --restart --collection tasks).
+
+Usage (from the backend directory, with the same .env as the server):
+
+    python migrate_storage.py [--batch-size 500] [--collection tasks] [--dry-run] [--restart]
+
+Documents are walked in _id order and progress is checkpointed in
+db.migrations after every batch, so an interrupted run continues where it
+stopped. Each update only $sets the converted fields and is guarded by their
+old values, so a concurrent write from the API (which already uses the new
+layout) is never overwritten. Safe to run while the app is serving.
+"""
+import argparse
+import asyncio
+
+from pymongo import UpdateOne
+
+from server import (
+    close_mongo_client,
+    db,
+    logger,
+    missing_similarity_fields,
+    task_to_storage,
+    to_storage_datetime,
+    STORAGE_SCHEMA_VERSION,
+    TASK_DATE_FIELDS,
+    USER_DATE_FIELDS,
+    VERIFICATION_TOKEN_DATE_FIELDS,
+)
+
+MIGRATION_ID = f"storage_v{STORAGE_SCHEMA_VERSION}"
+
+def convert_task(doc: dict) -> dict:
+    fields = {f: doc[f] for f in TASK_DATE_FIELDS + ("frequency", "confidentiality") if f in doc}
+    changes = {k: v for k, v in task_to_storage(fields).items() if v != doc[k] or type(v) is not type(doc[k])}
+    if doc.get("schema_version") != STORAGE_SCHEMA_VERSION:
+        changes["schema_version"] = STORAGE_SCHEMA_VERSION
+    if "name" in doc and "description" in doc:
+        changes.update(missing_similarity_fields(doc))
+    return changes
+
+def date_converter(fields):
+    def convert(doc: dict) -> dict:
+        return {f: to_storage_datetime(doc[f]) for f in fields if isinstance(doc.get(f), str)}
+    return convert
+
+def convert_task_change(doc: dict) -> dict:
+    changes = date_converter(("at",))(doc)
+    if isinstance(doc.get("task"), dict):
+        task = task_to_storage(doc["task"])
+        if task != doc["task"]:
+            changes["task"] = task
+    return changes
+
+CONVERTERS = {
+    "tasks": convert_task,
+    "users": date_converter(USER_DATE_FIELDS),
+    "verification_tokens": date_converter(VERIFICATION_TOKEN_DATE_FIELDS),
+    "token_revocations": date_converter(("revoked_before",)),
+    "task_changes": convert_task_change,
+    "app_config": date_converter(("updated_at",)),
+    "bootstrap": date_converter(("created_at",)),
+}
+
+async def migrate_batch(name: str, docs: list, convert, attempts: int = 5) -> int:
+    """Convert a batch; documents whose guard failed are re-read and retried"""
+    modified = 0
+    for _ in range(attempts):
+        operations, ids = [], []
+        for doc in docs:
+            changes = convert(doc)
+            if not changes:
+                continue
+            # Guard on the old values (or their absence): skip documents the API rewrote in the meantime
+            guard = {"_id": doc["_id"]}
+            for k in changes:
+                if k != "task":
+                    guard[k] = doc[k] if k in doc else {"$exists": False}
+            operations.append(UpdateOne(guard, {"$set": changes}))
+            ids.append(doc["_id"])
+        if not operations:
+            break
+        result = await db[name].bulk_write(operations, ordered=False)
+        modified += result.modified_count
+        if result.matched_count == len(operations):
+            break
+        docs = await db[name].find({"_id": {"$in": ids}}).to_list(None)
+    else:
+        logger.warning(f"{name}: algunos documentos cambiaron durante la migración; vuelve a ejecutar con --restart")
+    return modified
+
+async def migrate_collection(name: str, batch_size: int, dry_run: bool, restart: bool):
+    checkpoint_id = f"{MIGRATION_ID}:{name}"
+    checkpoint = None if restart else await db.migrations.find_one({"_id": checkpoint_id})
+    if checkpoint and checkpoint.get("done"):
+        logger.info(f"{name}: ya migrada")
+        return
+    last_id = checkpoint.get("last_id") if checkpoint else None
+    migrated = checkpoint.get("migrated", 0) if checkpoint else 0
+    convert = CONVERTERS[name]
+
+    while True:
+        query = {"_id": {"$gt": last_id}} if last_id is not None else {}
+        batch = await db[name].find(query).sort("_id", 1).limit(batch_size).to_list(batch_size)
+        if not batch:
+            break
+
+        if dry_run:
+            migrated += sum(1 for doc in batch if convert(doc))
+        else:
+            migrated += await migrate_batch(name, batch, convert)
+
+        last_id = batch[-1]["_id"]
+        if not dry_run:
+            await db.migrations.update_one(
+                {"_id": checkpoint_id},
+                {"$set": {"last_id": last_id, "migrated": migrated, "done": False}},
+                upsert=True
+            )
+        logger.info(f"{name}: {migrated} documentos convertidos (último _id {last_id})")
+
+    if not dry_run:
+        await db.migrations.update_one({"_id": checkpoint_id}, {"$set": {"done": True}}, upsert=True)
+    logger.info(f"{name}: migración completa ({migrated} documentos{' a convertir' if dry_run else ''})")
+
+async def main():
+    parser = argparse.ArgumentParser(description="Migra las colecciones al esquema de almacenamiento tipado")
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--collection", choices=sorted(CONVERTERS), action="append",
+                        help="Colección a migrar (repetible); por defecto todas")
+    parser.add_argument("--dry-run", action="store_true", help="Solo cuenta los documentos a convertir")
+    parser.add_argument("--restart", action="store_true", help="Ignora el checkpoint y empieza de nuevo")
+    args = parser.parse_args()
+
+    try:
+        for name in args.collection or list(CONVERTERS):
+            await migrate_collection(name, args.batch_size, args.dry_run, args.restart)
+    finally:
+        close_mongo_client()
+
+if __name__ == "__main__":
+    asyncio.run(main())
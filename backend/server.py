@@ -1,8 +1,11 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, status
+import time
+_MODULE_IMPORT_STARTED = time.perf_counter()
+
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, Query, Header, status
+from fastapi.responses import PlainTextResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
-from motor.motor_asyncio import AsyncIOMotorClient
 import os
 import logging
 from pathlib import Path
@@ -10,23 +13,182 @@ from pydantic import BaseModel, Field, EmailStr
 from typing import List, Optional
 import uuid
 from datetime import datetime, timezone, timedelta
-import jwt
-import bcrypt
 import asyncio
-import resend
+import hashlib
+import importlib
+import re
+import unicodedata
+import json
+import sys
+import threading
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
-# MongoDB connection
+# ===================== STARTUP =====================
+
+# Heavy or optional integrations are imported once, on first need or by the
+# background warmup, so a new worker can start serving before they load.
+WARMUP_MODULES = ["bcrypt", "jwt", "resend", "emergentintegrations.llm.chat"]
+STARTUP_WARMUP = os.environ.get('STARTUP_WARMUP', 'true').lower() == 'true'
+
+startup_timings: dict = {}  # step -> seconds
+startup_state = {"ready": False, "warm": False}
+_lazy_modules: dict = {}
+
+def record_startup_timing(step: str, started: float):
+    startup_timings[step] = round(time.perf_counter() - started, 4)
+
+def lazy_import(name: str):
+    """Import a module once, recording how long the first import took"""
+    module = _lazy_modules.get(name)
+    if module is None:
+        started = time.perf_counter()
+        module = importlib.import_module(name)
+        record_startup_timing(f"import:{name}", started)
+        _lazy_modules[name] = module
+    return module
+
+def get_llm_chat_classes():
+    chat_module = lazy_import("emergentintegrations.llm.chat")
+    return chat_module.LlmChat, chat_module.UserMessage
+
+# MongoDB connection (client created on first use)
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
-db = client[os.environ['DB_NAME']]
+_mongo_client = None
+
+def get_mongo_client():
+    global _mongo_client
+    if _mongo_client is None:
+        started = time.perf_counter()
+        motor_asyncio = lazy_import("motor.motor_asyncio")
+        _mongo_client = motor_asyncio.AsyncIOMotorClient(mongo_url, tz_aware=True)
+        record_startup_timing("mongo_client", started)
+    return _mongo_client
+
+# pymongo is only needed once Motor is: resolve its helpers lazily too
+def return_after():
+    return lazy_import("pymongo").ReturnDocument.AFTER
+
+def duplicate_key_error():
+    return lazy_import("pymongo.errors").DuplicateKeyError
+
+def close_mongo_client():
+    global _mongo_client
+    if _mongo_client is not None:
+        _mongo_client.close()
+        _mongo_client = None
+
+# Test mode: record the shape of every query so tests/test_query_plans.py can explain them
+QUERY_CAPTURE = os.environ.get('QUERY_CAPTURE', 'false').lower() == 'true'
+CAPTURED_OPERATIONS = {
+    "find", "find_one", "find_one_and_update", "update_one", "update_many",
+    "delete_one", "delete_many", "count_documents", "aggregate"
+}
+captured_queries: list = []
+
+class _CapturingCursor:
+    def __init__(self, cursor, entry: dict):
+        self._cursor = cursor
+        self._entry = entry
+
+    def sort(self, key_or_list, direction=None):
+        self._entry["sort"] = [(key_or_list, direction)] if direction is not None else list(key_or_list)
+        self._cursor = self._cursor.sort(key_or_list, direction) if direction is not None else self._cursor.sort(key_or_list)
+        return self
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+class _CapturingCollection:
+    def __init__(self, collection):
+        self._collection = collection
+
+    def __getattr__(self, name):
+        attr = getattr(self._collection, name)
+        if name not in CAPTURED_OPERATIONS:
+            return attr
+
+        def capture(*args, **kwargs):
+            entry = {
+                "collection": self._collection.name,
+                "operation": name,
+                "filter": args[0] if args else kwargs.get("filter", {}),
+                "sort": kwargs.get("sort"),
+                "projection": kwargs.get("projection") or (args[1] if name in ("find", "find_one") and len(args) > 1 else None)
+            }
+            captured_queries.append(entry)
+            result = attr(*args, **kwargs)
+            return _CapturingCursor(result, entry) if name == "find" else result
+        return capture
+
+class _LazyDatabase:
+    """Stands in for the Motor database until the first collection access"""
+    def __init__(self, name: str):
+        self._name = name
+
+    def _database(self):
+        return get_mongo_client()[self._name]
+
+    def _collection(self, collection):
+        if QUERY_CAPTURE and hasattr(collection, "find_one"):
+            return _CapturingCollection(collection)
+        return collection
+
+    def __getattr__(self, name):
+        return self._collection(getattr(self._database(), name))
+
+    def __getitem__(self, name):
+        return self._collection(self._database()[name])
+
+db = _LazyDatabase(os.environ['DB_NAME'])
 
 # JWT Config
 JWT_SECRET = os.environ.get('JWT_SECRET', 'default-secret-key')
 JWT_ALGORITHM = "HS256"
 JWT_EXPIRATION_HOURS = 24
+# Stateless mode trusts signed claims on identity-only routes (no db.users read)
+AUTH_STATELESS = os.environ.get('AUTH_STATELESS', 'false').lower() == 'true'
+REVOCATION_REFRESH_SECONDS = int(os.environ.get('REVOCATION_REFRESH_SECONDS', '30'))
+
+# Near-duplicate detection config
+SIMILARITY_THRESHOLD = float(os.environ.get('SIMILARITY_THRESHOLD', '0.8'))
+SIMILARITY_SCOPE = os.environ.get('SIMILARITY_SCOPE', 'user')  # user | global
+MINHASH_PERMUTATIONS = 64
+MINHASH_BANDS = 16
+
+# AI analysis config
+ANALYSIS_PROVIDER = "openai"
+ANALYSIS_MODEL = "gpt-4o"
+PROMPT_VERSION = "2"
+# Analyses made with another prompt/model version are re-run by the scheduler
+ANALYSIS_VERSION = f"{PROMPT_VERSION}:{ANALYSIS_PROVIDER}/{ANALYSIS_MODEL}"
+PROMPT_NAME_TOKEN_BUDGET = 64
+PROMPT_DESCRIPTION_TOKEN_BUDGET = int(os.environ.get('PROMPT_DESCRIPTION_TOKEN_BUDGET', '600'))
+
+# Background re-analysis of changed/stale tasks (opt-in)
+REANALYSIS_ENABLED = os.environ.get('REANALYSIS_ENABLED', 'false').lower() == 'true'
+REANALYSIS_INTERVAL_SECONDS = int(os.environ.get('REANALYSIS_INTERVAL_SECONDS', '60'))
+REANALYSIS_BATCH_SIZE = int(os.environ.get('REANALYSIS_BATCH_SIZE', '10'))
+REANALYSIS_CALL_SPACING_SECONDS = float(os.environ.get('REANALYSIS_CALL_SPACING_SECONDS', '2'))
+REANALYSIS_LEASE_MINUTES = 5
+# Failed re-analyses keep their lease for 5, 10, 20... minutes, up to this cap
+REANALYSIS_MAX_BACKOFF_MINUTES = 24 * 60
+
+# Stored responses for Idempotency-Key retries
+IDEMPOTENCY_KEY_TTL_HOURS = 24
+# A retry can take over a key left pending for this long (its worker died);
+# must outlast the slowest request, an LLM analysis
+IDEMPOTENCY_LOCK_SECONDS = 120
+
+# On-demand profiler
+PROFILE_MAX_STACKS = 5000
+
+# Per-user task change feed (delta sync + history)
+TASK_CHANGE_LOG_LIMIT = int(os.environ.get('TASK_CHANGE_LOG_LIMIT', '500'))
+TASK_CHANGE_LOG_TRIM_EVERY = 50
+# A sequence number missing for longer than this was reserved by a writer that died
+TASK_CHANGE_GAP_GRACE_SECONDS = 30
 
 # Create the main app
 app = FastAPI()
@@ -105,6 +267,8 @@ class Task(BaseModel):
     suggested_profile: Optional[str] = None
     suggested_hours: Optional[str] = None
     analyzed_at: Optional[str] = None
+    needs_reanalysis: bool = False  # inputs changed after analyzed_at
+    reused_from: Optional[str] = None  # task_id whose analysis was reused
     created_at: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
 
 class AppConfig(BaseModel):
@@ -114,17 +278,99 @@ class AppConfig(BaseModel):
     app_name: str = "SmartTasks"
     updated_at: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
 
+class UserStatusUpdate(BaseModel):
+    is_disabled: bool
+
+class AnalyticsRebuildRequest(BaseModel):
+    days: int = Field(default=30, ge=1, le=3650)
+
+class ProfilerStart(BaseModel):
+    requests: int = Field(default=20, ge=1, le=10000)
+    seconds: Optional[int] = Field(default=None, ge=1, le=3600)
+    route: Optional[str] = None  # path prefix, e.g. /api/report
+    interval_ms: int = Field(default=5, ge=1, le=1000)
+
 class ConfigUpdate(BaseModel):
     resend_api_key: Optional[str] = None
     sender_email: Optional[str] = None
     app_name: Optional[str] = None
 
+# ===================== STORAGE SCHEMA =====================
+
+# Documents store native BSON dates and small integer codes; the API models
+# keep ISO strings and Spanish labels. Readers accept both layouts so
+# migrate_storage.py can run while the app is serving.
+STORAGE_SCHEMA_VERSION = 2
+
+FREQUENCY_CODES = {"Diaria": 1, "Semanal": 2, "Mensual": 3, "Ocasional": 4}
+CONFIDENTIALITY_CODES = {"Baja": 1, "Media": 2, "Alta": 3}
+FREQUENCY_LABELS = {code: label for label, code in FREQUENCY_CODES.items()}
+CONFIDENTIALITY_LABELS = {code: label for label, code in CONFIDENTIALITY_CODES.items()}
+
+TASK_DATE_FIELDS = ("created_at", "analyzed_at")
+USER_DATE_FIELDS = ("created_at",)
+VERIFICATION_TOKEN_DATE_FIELDS = ("created_at", "expires_at")
+
+def utcnow() -> datetime:
+    return datetime.now(timezone.utc)
+
+def to_storage_datetime(value):
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    if isinstance(value, datetime) and value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value
+
+def from_storage_datetime(value):
+    if isinstance(value, datetime):
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=timezone.utc)
+        return value.isoformat()
+    return value
+
+def dates_to_storage(doc: dict, fields) -> dict:
+    return {**doc, **{f: to_storage_datetime(doc[f]) for f in fields if f in doc}}
+
+def dates_from_storage(doc: dict, fields) -> dict:
+    return {**doc, **{f: from_storage_datetime(doc[f]) for f in fields if f in doc}}
+
+def task_to_storage(data: dict) -> dict:
+    """Map API task fields (full document or partial update) to the stored layout"""
+    doc = dates_to_storage(data, TASK_DATE_FIELDS)
+    if doc.get("frequency") in FREQUENCY_CODES:
+        doc["frequency"] = FREQUENCY_CODES[doc["frequency"]]
+    if doc.get("confidentiality") in CONFIDENTIALITY_CODES:
+        doc["confidentiality"] = CONFIDENTIALITY_CODES[doc["confidentiality"]]
+    return doc
+
+def task_from_storage(doc: Optional[dict]) -> Optional[dict]:
+    if doc is None:
+        return None
+    data = dates_from_storage(doc, TASK_DATE_FIELDS)
+    data.pop("schema_version", None)
+    if isinstance(data.get("frequency"), int):
+        data["frequency"] = FREQUENCY_LABELS.get(data["frequency"], str(data["frequency"]))
+    if isinstance(data.get("confidentiality"), int):
+        data["confidentiality"] = CONFIDENTIALITY_LABELS.get(data["confidentiality"])
+    return data
+
+def new_task_document(task: Task) -> dict:
+    return {**task_to_storage(task.model_dump()), "schema_version": STORAGE_SCHEMA_VERSION}
+
+def enum_filter(value: str, codes: dict):
+    """Match a label whether the document is migrated (int code) or not (string)"""
+    if value in codes:
+        return {"$in": [codes[value], value]}
+    return value
+
 # ===================== AUTH HELPERS =====================
 
 def hash_password(password: str) -> str:
+    bcrypt = lazy_import("bcrypt")
     return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
 
 def verify_password(password: str, password_hash: str) -> bool:
+    bcrypt = lazy_import("bcrypt")
     return bcrypt.checkpw(password.encode('utf-8'), password_hash.encode('utf-8'))
 
 def create_jwt_token(user_id: str, email: str, is_admin: bool) -> str:
@@ -132,11 +378,13 @@ def create_jwt_token(user_id: str, email: str, is_admin: bool) -> str:
         "user_id": user_id,
         "email": email,
         "is_admin": is_admin,
+        "iat": datetime.now(timezone.utc),
         "exp": datetime.now(timezone.utc) + timedelta(hours=JWT_EXPIRATION_HOURS)
     }
-    return jwt.encode(payload, JWT_SECRET, algorithm=JWT_ALGORITHM)
+    return lazy_import("jwt").encode(payload, JWT_SECRET, algorithm=JWT_ALGORITHM)
 
 def decode_jwt_token(token: str) -> dict:
+    jwt = lazy_import("jwt")
     try:
         return jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
     except jwt.ExpiredSignatureError:
@@ -144,13 +392,81 @@ def decode_jwt_token(token: str) -> dict:
     except jwt.InvalidTokenError:
         raise HTTPException(status_code=401, detail="Token inválido")
 
+# user_id -> tokens issued before this instant are rejected
+_revoked_before: dict = {}
+
+def is_token_revoked(payload: dict) -> bool:
+    revoked_before = _revoked_before.get(payload["user_id"])
+    if revoked_before is None:
+        return False
+    return payload.get("iat", 0) <= revoked_before.timestamp()
+
+async def load_revocations():
+    """Reload the revocation list; only entries that can still affect unexpired tokens are kept"""
+    cutoff = utcnow() - timedelta(hours=JWT_EXPIRATION_HOURS)
+    # Dates and not-yet-migrated ISO strings compare in separate type brackets
+    docs = await db.token_revocations.find(
+        {"$or": [{"revoked_before": {"$gte": cutoff}}, {"revoked_before": {"$gte": cutoff.isoformat()}}]},
+        {"_id": 0, "user_id": 1, "revoked_before": 1}
+    ).to_list(None)
+    _revoked_before.clear()
+    _revoked_before.update({d["user_id"]: to_storage_datetime(d["revoked_before"]) for d in docs})
+
+async def refresh_revocations_periodically():
+    while True:
+        try:
+            await load_revocations()
+        except Exception as e:
+            logger.error(f"Error cargando revocaciones: {e}")
+        await asyncio.sleep(REVOCATION_REFRESH_SECONDS)
+
+async def revoke_user_tokens(user_id: str):
+    """Invalidate every token issued to the user so far (picked up by other workers on refresh)"""
+    now = utcnow()
+    await db.token_revocations.update_one(
+        {"user_id": user_id},
+        {"$set": {"user_id": user_id, "revoked_before": now}},
+        upsert=True
+    )
+    _revoked_before[user_id] = now
+
+# Set at startup once the unique users.email index is confirmed; until then (or
+# if it can't be built, e.g. existing duplicate emails) register pre-reads the email
+email_index_ready = False
+
+async def check_email_index():
+    global email_index_ready
+    indexes = await db.users.index_information()
+    email_index_ready = any(index["key"] == [("email", 1)] and index.get("unique") for index in indexes.values())
+    if not email_index_ready:
+        logger.error("Falta el índice único users.email (¿emails duplicados?); el registro comprobará duplicados con una lectura previa")
+
 async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
     payload = decode_jwt_token(credentials.credentials)
+    if is_token_revoked(payload):
+        raise HTTPException(status_code=401, detail="Token revocado")
     user = await db.users.find_one({"id": payload["user_id"]}, {"_id": 0})
-    if not user:
+    if not user or user.get("is_disabled"):
         raise HTTPException(status_code=401, detail="Usuario no encontrado")
     return user
 
+async def get_current_identity(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    """Identity for routes that only need who the caller is.
+
+    In stateless mode the signed claims are trusted (checked against the
+    in-memory revocation list), otherwise falls back to the users lookup.
+    """
+    if not AUTH_STATELESS:
+        return await get_current_user(credentials)
+    payload = decode_jwt_token(credentials.credentials)
+    if is_token_revoked(payload):
+        raise HTTPException(status_code=401, detail="Token revocado")
+    return {
+        "id": payload["user_id"],
+        "email": payload["email"],
+        "is_admin": payload.get("is_admin", False)
+    }
+
 async def get_admin_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
     user = await get_current_user(credentials)
     if not user.get("is_admin"):
@@ -162,12 +478,21 @@ async def get_admin_user(credentials: HTTPAuthorizationCredentials = Depends(sec
 async def get_app_config() -> dict:
     config = await db.app_config.find_one({"id": "app_config"}, {"_id": 0})
     if not config:
-        config = AppConfig().model_dump()
-        await db.app_config.insert_one(config)
-    return config
-
-async def send_verification_email(email: str, token: str, frontend_url: str) -> dict:
-    config = await get_app_config()
+        # Upsert so concurrent first requests (e.g. two first signups) all get the same document
+        defaults = dates_to_storage(AppConfig().model_dump(), ("updated_at",))
+        defaults.pop("id")
+        config = await db.app_config.find_one_and_update(
+            {"id": "app_config"},
+            {"$setOnInsert": defaults},
+            projection={"_id": 0},
+            upsert=True,
+            return_document=return_after()
+        )
+    return dates_from_storage(config, ("updated_at",))
+
+async def send_verification_email(email: str, token: str, frontend_url: str, config: Optional[dict] = None) -> dict:
+    if config is None:
+        config = await get_app_config()
     verification_link = f"{frontend_url}/verify-email?token={token}"
     
     if not config.get("resend_api_key") or not config.get("sender_email"):
@@ -175,6 +500,7 @@ async def send_verification_email(email: str, token: str, frontend_url: str) ->
         return {"status": "testing", "verification_link": verification_link}
     
     try:
+        resend = lazy_import("resend")
         resend.api_key = config["resend_api_key"]
         params = {
             "from": config["sender_email"],
@@ -196,28 +522,666 @@ async def send_verification_email(email: str, token: str, frontend_url: str) ->
         logger.error(f"Error enviando email: {str(e)}")
         return {"status": "testing", "verification_link": verification_link, "error": str(e)}
 
+# ===================== ANALYTICS HELPERS =====================
+
+async def record_daily_metrics(increments: dict):
+    """Increment today's platform-wide counters (one small document per UTC day)"""
+    now = utcnow()
+    try:
+        await db.analytics_daily.update_one(
+            {"_id": now.strftime("%Y-%m-%d")},
+            {"$inc": increments, "$set": {"updated_at": now}},
+            upsert=True
+        )
+    except Exception as e:
+        # Analytics must never break the request that produced them
+        logger.error(f"Error registrando métricas: {e}")
+
+# Decisions come from LLM output: only known codes become field paths
+DECISION_CODES = ("C", "D", "A", "E")
+
+def analysis_metrics(decision: Optional[str], reused: bool = False) -> dict:
+    metrics = {"analyses": 1}
+    if reused:
+        metrics["analyses_reused"] = 1
+    if decision in DECISION_CODES:
+        metrics[f"decisions.{decision}"] = 1
+    return metrics
+
+async def rebuild_daily_analytics(days: int) -> int:
+    """Backfill daily buckets from the tasks collection.
+
+    Uses $max so counters kept incrementally (which also see re-analyses and
+    deleted tasks) are never lowered; LLM counters can't be derived from tasks
+    and are left untouched.
+    """
+    since = (utcnow() - timedelta(days=days)).replace(hour=0, minute=0, second=0, microsecond=0)
+    buckets = {}
+
+    def since_match(field: str) -> dict:
+        # Dates and not-yet-migrated ISO strings compare in separate type brackets
+        return {"$or": [{field: {"$gte": since}}, {field: {"$gte": since.strftime("%Y-%m-%d")}}]}
+
+    def day_of(field: str) -> dict:
+        return {"$cond": [
+            {"$eq": [{"$type": f"${field}"}, "date"]},
+            {"$dateToString": {"format": "%Y-%m-%d", "date": f"${field}"}},
+            {"$substrCP": [f"${field}", 0, 10]}
+        ]}
+
+    created = db.tasks.aggregate([
+        {"$match": since_match("created_at")},
+        {"$group": {"_id": day_of("created_at"), "count": {"$sum": 1}}}
+    ])
+    async for row in created:
+        buckets.setdefault(row["_id"], {})["tasks_created"] = row["count"]
+
+    analyzed = db.tasks.aggregate([
+        {"$match": since_match("analyzed_at")},
+        {"$group": {
+            "_id": {"day": day_of("analyzed_at"), "decision": "$decision"},
+            "count": {"$sum": 1}
+        }}
+    ])
+    async for row in analyzed:
+        bucket = buckets.setdefault(row["_id"]["day"], {})
+        bucket["analyses"] = bucket.get("analyses", 0) + row["count"]
+        if row["_id"]["decision"] in DECISION_CODES:
+            bucket[f"decisions.{row['_id']['decision']}"] = row["count"]
+
+    now = utcnow()
+    for day, values in buckets.items():
+        await db.analytics_daily.update_one(
+            {"_id": day},
+            {"$max": values, "$set": {"updated_at": now}},
+            upsert=True
+        )
+    return len(buckets)
+
+# ===================== CHANGE FEED HELPERS =====================
+
+async def record_task_change(user_id: str, task_id: str, op: str, task: Optional[dict] = None,
+                             fields: Optional[dict] = None) -> int:
+    """Append a task upsert/delete to the user's change log and return its sequence number"""
+    counter = await db.counters.find_one_and_update(
+        {"_id": f"task_changes:{user_id}"},
+        {"$inc": {"seq": 1}, "$set": {"reserved_at": utcnow()}},
+        upsert=True,
+        return_document=return_after()
+    )
+    seq = counter["seq"]
+    if fields is not None:
+        fields = task_to_storage({k: v for k, v in fields.items() if k not in TASK_PROJECTION})
+    await db.task_changes.insert_one({
+        "user_id": user_id,
+        "seq": seq,
+        "task_id": task_id,
+        "op": op,  # upsert | delete
+        "fields": fields,
+        "task": task_to_storage(task) if task else None,
+        "at": utcnow()
+    })
+    # Keep the log bounded; trimming in batches avoids a delete per write
+    if seq > TASK_CHANGE_LOG_LIMIT and seq % TASK_CHANGE_LOG_TRIM_EVERY == 0:
+        await db.task_changes.delete_many({"user_id": user_id, "seq": {"$lte": seq - TASK_CHANGE_LOG_LIMIT}})
+    return seq
+
+# ===================== IDEMPOTENCY HELPERS =====================
+
+async def claim_idempotency_key(doc_id: str, request_hash: str, lock_id: str, attempts: int = 3):
+    """Take the key for this request; returns the stored response if it already completed"""
+    for _ in range(attempts):
+        now = utcnow()
+        lock = {"status": "pending", "lock_id": lock_id, "locked_until": now + timedelta(seconds=IDEMPOTENCY_LOCK_SECONDS)}
+        try:
+            await db.idempotency_keys.insert_one({
+                "_id": doc_id,
+                "request_hash": request_hash,
+                "created_at": now,
+                "expires_at": now + timedelta(hours=IDEMPOTENCY_KEY_TTL_HOURS),
+                **lock
+            })
+            return None
+        except duplicate_key_error():
+            existing = await db.idempotency_keys.find_one({"_id": doc_id})
+        if existing is None:
+            # Released between the insert and the read: try to insert again
+            continue
+        if existing["request_hash"] != request_hash:
+            raise HTTPException(status_code=422, detail="Idempotency-Key ya usada con otra solicitud")
+        if existing["status"] == "done":
+            return {"response": existing["response"]}
+        locked_until = to_storage_datetime(existing.get("locked_until"))
+        if locked_until and locked_until > now:
+            raise HTTPException(status_code=409, detail="Solicitud en proceso")
+        # The worker holding the key died: take it over unless another retry just did
+        taken = await db.idempotency_keys.update_one(
+            {"_id": doc_id, "status": "pending", "locked_until": existing.get("locked_until")},
+            {"$set": lock}
+        )
+        if taken.modified_count:
+            return None
+    raise HTTPException(status_code=409, detail="Solicitud en proceso")
+
+async def run_idempotent(user_id: str, scope: str, key: Optional[str], request_hash: str, work):
+    """Run `work` once per Idempotency-Key; retries get the stored response back.
+
+    A retry that arrives while the first request is still running gets a 409,
+    a failed request releases its key so it can be retried, and a key left
+    pending by a crashed worker can be taken over once its lock expires.
+    """
+    if not key:
+        return await work()
+
+    doc_id = f"{user_id}:{scope}:{key}"
+    lock_id = str(uuid.uuid4())
+    stored = await claim_idempotency_key(doc_id, request_hash, lock_id)
+    if stored is not None:
+        return stored["response"]
+
+    owned = {"_id": doc_id, "lock_id": lock_id}
+    try:
+        response = await work()
+    except BaseException:
+        await db.idempotency_keys.delete_one(owned)
+        raise
+    await db.idempotency_keys.update_one(
+        owned,
+        {"$set": {"status": "done", "response": response}, "$unset": {"lock_id": "", "locked_until": ""}}
+    )
+    return response
+
+# ===================== SIMILARITY HELPERS =====================
+
+# Internal fields used for near-duplicate lookup, never returned to clients
+TASK_PROJECTION = {
+    "_id": 0, "minhash": 0, "lsh_bands": 0, "llm_usage": 0,
+    "inputs_changed_at": 0, "reanalysis_lease_until": 0, "reanalysis_attempts": 0
+}
+
+ANALYSIS_FIELDS = [
+    "impact", "risk", "effort", "confidentiality", "decision",
+    "decision_justification", "suggested_profile", "suggested_hours"
+]
+
+# Inputs of the decision rules that the user may enter; the analysis fills them otherwise
+DECISION_INPUT_FIELDS = ("impact", "risk", "effort", "confidentiality")
+
+# Fields the analysis is derived from; changing them makes it stale
+ANALYSIS_INPUT_FIELDS = ("name", "description", "frequency", "duration") + DECISION_INPUT_FIELDS
+
+# Paraphrases the task's private description: never shown or copied across users
+PRIVATE_ANALYSIS_FIELDS = ("decision_justification",)
+
+SPANISH_STOPWORDS = {
+    "a", "al", "con", "de", "del", "el", "en", "la", "las", "lo", "los",
+    "para", "por", "que", "se", "su", "sus", "un", "una", "y", "o"
+}
+
+_MERSENNE_PRIME = (1 << 61) - 1
+_MINHASH_SEEDS = [
+    (int.from_bytes(hashlib.blake2b(f"a{i}".encode(), digest_size=8).digest(), "big") % _MERSENNE_PRIME | 1,
+     int.from_bytes(hashlib.blake2b(f"b{i}".encode(), digest_size=8).digest(), "big") % _MERSENNE_PRIME)
+    for i in range(MINHASH_PERMUTATIONS)
+]
+
+def normalize_task_text(name: str, description: str) -> str:
+    """Lowercase, strip accents/punctuation and drop Spanish stopwords"""
+    text = unicodedata.normalize("NFKD", f"{name} {description}".lower())
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    words = re.findall(r"[a-z0-9]+", text)
+    return " ".join(w for w in words if w not in SPANISH_STOPWORDS)
+
+def task_shingles(text: str, size: int = 3) -> set:
+    # Character shingles per word so "pagar"/"pago" still share "pag"
+    shingles = set()
+    for word in text.split():
+        if len(word) <= size:
+            shingles.add(word)
+        else:
+            shingles.update(word[i:i + size] for i in range(len(word) - size + 1))
+    return shingles
+
+def compute_minhash(name: str, description: str) -> List[int]:
+    shingles = task_shingles(normalize_task_text(name, description))
+    if not shingles:
+        return []
+    hashes = [int.from_bytes(hashlib.blake2b(s.encode(), digest_size=8).digest(), "big") for s in shingles]
+    return [min((a * h + b) % _MERSENNE_PRIME for h in hashes) for a, b in _MINHASH_SEEDS]
+
+def compute_lsh_bands(minhash: List[int]) -> List[str]:
+    if not minhash:
+        return []
+    rows = len(minhash) // MINHASH_BANDS
+    return [
+        f"{band}:" + hashlib.blake2b(str(minhash[band * rows:(band + 1) * rows]).encode(), digest_size=8).hexdigest()
+        for band in range(MINHASH_BANDS)
+    ]
+
+def minhash_similarity(a: List[int], b: List[int]) -> float:
+    if not a or not b or len(a) != len(b):
+        return 0.0
+    return sum(1 for x, y in zip(a, b) if x == y) / len(a)
+
+def similarity_fields(name: str, description: str) -> dict:
+    minhash = compute_minhash(name, description)
+    return {"minhash": minhash, "lsh_bands": compute_lsh_bands(minhash)}
+
+def missing_similarity_fields(task: dict) -> dict:
+    """Similarity fields for tasks stored before they existed, backfilled when analyzed"""
+    return {} if "minhash" in task else similarity_fields(task["name"], task["description"])
+
+async def find_similar_analyzed_tasks(task: dict, user_id: str, threshold: Optional[float] = None,
+                                      limit: int = 5) -> List[dict]:
+    """Find already analyzed near-duplicates of a task, best match first.
+
+    Only candidates with the same frequency and the same values for every
+    decision input the task already has qualify, since the decision rules
+    depend on them. Cross-user lookup follows SIMILARITY_SCOPE only, and
+    `threshold` can only make matching stricter than SIMILARITY_THRESHOLD.
+    """
+    threshold = max(threshold or 0, SIMILARITY_THRESHOLD)
+    minhash = task.get("minhash") or compute_minhash(task["name"], task["description"])
+    bands = compute_lsh_bands(minhash)
+    if not bands:
+        return []
+
+    query = {
+        "lsh_bands": {"$in": bands},
+        "decision": {"$ne": None},
+        "reused_from": None,
+        "id": {"$ne": task["id"]}
+    }
+    inputs = task_from_storage(task)
+    query["frequency"] = enum_filter(inputs["frequency"], FREQUENCY_CODES)
+    for field in DECISION_INPUT_FIELDS:
+        if inputs.get(field) is not None:
+            query[field] = enum_filter(inputs[field], CONFIDENTIALITY_CODES) if field == "confidentiality" else inputs[field]
+    if SIMILARITY_SCOPE != "global":
+        query["user_id"] = user_id
+
+    candidates = await db.tasks.find(query, {"_id": 0, "lsh_bands": 0}).to_list(200)
+    matches = []
+    for candidate in candidates:
+        score = minhash_similarity(minhash, candidate.pop("minhash", None))
+        if score >= threshold:
+            matches.append({"similarity": round(score, 3), "task": candidate})
+    matches.sort(key=lambda m: m["similarity"], reverse=True)
+    return matches[:limit]
+
+async def reuse_similar_analysis(task: dict, user_id: str) -> Optional[dict]:
+    """Copy the analysis of the closest near-duplicate, if any, instead of calling the LLM"""
+    matches = await find_similar_analyzed_tasks(task, user_id, limit=1)
+    if not matches:
+        return None
+    source = task_from_storage(matches[0]["task"])
+    # Derived fields only: decision inputs the user entered are left alone
+    update_data = {
+        field: source.get(field) for field in ANALYSIS_FIELDS
+        if not (field in DECISION_INPUT_FIELDS and task.get(field) is not None)
+    }
+    if source["user_id"] != user_id:
+        update_data.update({field: None for field in PRIVATE_ANALYSIS_FIELDS})
+    update_data["reused_from"] = source["id"]
+    update_data["analysis_version"] = source.get("analysis_version")
+    update_data["needs_reanalysis"] = False
+    update_data["analyzed_at"] = utcnow()
+    update_data.update(missing_similarity_fields(task))
+    updated_task = task_from_storage(await db.tasks.find_one_and_update(
+        {"id": task["id"]},
+        {"$set": task_to_storage(update_data)},
+        projection=TASK_PROJECTION,
+        return_document=return_after()
+    ))
+    await record_task_change(user_id, task["id"], "upsert", updated_task, update_data)
+    await record_daily_metrics(analysis_metrics(update_data["decision"], reused=True))
+    logger.info(f"Analysis for task {task['id']} reused from {source['id']} (similarity {matches[0]['similarity']})")
+    return updated_task
+
+# ===================== PROMPT HELPERS =====================
+
+# Everything before the task block is identical for every call and the task
+# comes last. At roughly 450 tokens the prefix is below the 1024-token minimum
+# of OpenAI's prompt caching, so no cache hits are expected from it as is.
+# Bump PROMPT_VERSION when it changes.
+ANALYSIS_SYSTEM_MESSAGE = "Eres un consultor empresarial experto en optimización de tiempo y delegación de tareas para PyMEs. Responde siempre en español y en formato JSON."
+
+ANALYSIS_PROMPT_PREFIX = """Analiza la tarea empresarial indicada al final y proporciona una recomendación estructurada.
+
+REGLAS DE DECISIÓN (aplica en este orden de prioridad):
+
+1. CONSERVAR (C): Cuando Riesgo ≥ 4 O Confidencialidad = Alta
+   - Tareas críticas que el dueño debe mantener temporalmente
+
+2. DELEGAR (D): Cuando Esfuerzo ≥ 3 Y Impacto ≥ 3 Y Riesgo ≤ 3
+   - Tareas que pueden asignarse a otros
+
+3. AUTOMATIZAR (A): Cuando es tarea recurrente (frecuencia alta) Y proceso repetitivo con reglas claras
+   - Tareas que pueden sistematizarse
+
+4. ELIMINAR (E): Cuando Impacto ≤ 2 Y no tiene vínculo claro con objetivos del negocio
+   - Tareas que no agregan valor
+
+PERFILES PARA DELEGACIÓN:
+- Prospección comercial → Agencia externa (10-20 hrs/sem)
+- Pagos y conciliaciones → Administrativo interno (2-4 hrs/sem)
+- Marketing y redes sociales → Community Manager o Agencia externa (4-8 hrs/sem)
+- Legal y contratos → Estudio jurídico externo (2-4 hrs/sem)
+- Contabilidad e impuestos → Estudio contable externo (4-8 hrs/sem)
+
+Responde ÚNICAMENTE en formato JSON con esta estructura exacta:
+{
+    "impact": <número 1-5>,
+    "risk": <número 1-5>,
+    "effort": <número 1-5>,
+    "confidentiality": "<Baja|Media|Alta>",
+    "decision": "<C|D|A|E>",
+    "decision_justification": "<explicación breve en español de por qué esta decisión>",
+    "suggested_profile": "<perfil sugerido si es D, null si no>",
+    "suggested_hours": "<horas sugeridas si es D, null si no>"
+}
+"""
+
+ANALYSIS_TASK_TEMPLATE = """
+TAREA:
+- Nombre: {name}
+- Descripción: {description}
+- Frecuencia: {frequency}
+- Duración estimada: {duration}
+- Impacto actual (si proporcionado): {impact}
+- Riesgo actual (si proporcionado): {risk}
+- Esfuerzo actual (si proporcionado): {effort}
+- Confidencialidad actual (si proporcionado): {confidentiality}"""
+
+_token_encoder = None
+
+def count_tokens(text: str) -> int:
+    """Local token estimate: tiktoken when installed, ~4 chars/token otherwise"""
+    global _token_encoder
+    if _token_encoder is None:
+        try:
+            _token_encoder = lazy_import("tiktoken").get_encoding("o200k_base")
+        except Exception:
+            _token_encoder = False
+    if _token_encoder:
+        return len(_token_encoder.encode(text))
+    return len(text) // 4 + 1
+
+def truncate_to_tokens(text: str, budget: int) -> str:
+    if count_tokens(text) <= budget:
+        return text
+    if _token_encoder:
+        return _token_encoder.decode(_token_encoder.encode(text)[:budget]) + "…"
+    return text[:budget * 4] + "…"
+
+def build_analysis_prompt(task: dict) -> str:
+    def or_default(value):
+        return "No especificado" if value is None else value
+    return ANALYSIS_PROMPT_PREFIX + ANALYSIS_TASK_TEMPLATE.format(
+        name=truncate_to_tokens(task["name"], PROMPT_NAME_TOKEN_BUDGET),
+        description=truncate_to_tokens(task["description"], PROMPT_DESCRIPTION_TOKEN_BUDGET),
+        frequency=task["frequency"],
+        duration=task["duration"],
+        impact=or_default(task.get("impact")),
+        risk=or_default(task.get("risk")),
+        effort=or_default(task.get("effort")),
+        confidentiality=or_default(task.get("confidentiality"))
+    )
+
+def parse_analysis_response(response: str) -> dict:
+    response_text = response.strip()
+    if response_text.startswith("```json"):
+        response_text = response_text[7:]
+    if response_text.startswith("```"):
+        response_text = response_text[3:]
+    if response_text.endswith("```"):
+        response_text = response_text[:-3]
+    return json.loads(response_text.strip())
+
+async def run_task_analysis(task: dict) -> dict:
+    """Run one LLM analysis and return the task fields to store"""
+    LlmChat, UserMessage = get_llm_chat_classes()
+    
+    prompt = build_analysis_prompt(task)
+    chat = LlmChat(
+        api_key=os.environ.get("EMERGENT_LLM_KEY"),
+        session_id=f"task-analysis-{task['id']}",
+        system_message=ANALYSIS_SYSTEM_MESSAGE
+    ).with_model(ANALYSIS_PROVIDER, ANALYSIS_MODEL)
+    
+    await record_daily_metrics({"llm_calls": 1})
+    try:
+        response = await chat.send_message(UserMessage(text=prompt))
+        analysis = parse_analysis_response(response)
+    except Exception:
+        await record_daily_metrics({"llm_failures": 1})
+        raise
+    
+    # LlmChat only returns the text, so these are local estimates, not the
+    # provider's billed usage (which also adds chat formatting overhead)
+    usage = {
+        "estimated": True,
+        "input_tokens": count_tokens(ANALYSIS_SYSTEM_MESSAGE) + count_tokens(prompt),
+        "output_tokens": count_tokens(response),
+        "prompt_version": PROMPT_VERSION,
+        "model": f"{ANALYSIS_PROVIDER}/{ANALYSIS_MODEL}"
+    }
+    update_data = {field: analysis.get(field) for field in ANALYSIS_FIELDS}
+    update_data.update({
+        "analyzed_at": utcnow(),
+        "reused_from": None,
+        "analysis_version": ANALYSIS_VERSION,
+        "needs_reanalysis": False,
+        "llm_usage": usage
+    })
+    await record_daily_metrics({
+        **analysis_metrics(update_data["decision"]),
+        "input_tokens": usage["input_tokens"],
+        "output_tokens": usage["output_tokens"]
+    })
+    return update_data
+
+# ===================== ADMIN BOOTSTRAP =====================
+
+# Set once the first-admin sentinel is known to exist, so later signups skip the write
+_admin_bootstrapped = False
+
+async def claim_first_admin(user_id: str) -> bool:
+    """Atomically elect the first registered user as admin.
+
+    The sentinel's fixed _id makes the insert succeed for exactly one caller,
+    whatever the size of the users collection.
+    """
+    global _admin_bootstrapped
+    if _admin_bootstrapped:
+        return False
+    # Deployments that predate the sentinel already have their admin
+    existing_user = await db.users.find_one({}, {"_id": 1})
+    try:
+        await db.bootstrap.insert_one({
+            "_id": "first_admin",
+            "user_id": None if existing_user else user_id,
+            "created_at": utcnow()
+        })
+        claimed = not existing_user
+    except duplicate_key_error():
+        claimed = False
+    _admin_bootstrapped = True
+    return claimed
+
+async def release_first_admin(user_id: str):
+    global _admin_bootstrapped
+    result = await db.bootstrap.delete_one({"_id": "first_admin", "user_id": user_id})
+    if result.deleted_count:
+        _admin_bootstrapped = False
+
+# ===================== PROFILER =====================
+
+class SamplingProfiler:
+    """On-demand sampling profiler for live requests (per worker).
+
+    While armed, a daemon thread samples the event loop thread's stack every
+    `interval` seconds, but only while a matching request is in flight, and
+    aggregates the samples as collapsed stacks ("a;b;c count" lines, the
+    input format of flamegraph.pl / speedscope). Disarmed, the only cost is
+    one attribute check per request in the middleware.
+    """
+
+    def __init__(self):
+        self.armed = False
+        self.session = None
+        self._lock = threading.Lock()
+
+    def start(self, requests: int, seconds: Optional[int], route: Optional[str], interval_ms: int):
+        with self._lock:
+            if self.armed:
+                raise HTTPException(status_code=409, detail="El profiler ya está activo")
+            self.session = {
+                "id": str(uuid.uuid4()),
+                "route": route,
+                "requests_remaining": requests,
+                "requests_profiled": 0,
+                "interval": interval_ms / 1000,
+                "deadline": time.monotonic() + seconds if seconds else None,
+                "started_at": utcnow(),
+                "active": 0,
+                "samples": 0,
+                "stacks": {},
+                "loop_thread_id": threading.get_ident()
+            }
+            self.armed = True
+            self.session["thread"] = threading.Thread(target=self._sample_loop, args=(self.session,), daemon=True)
+            self.session["thread"].start()
+            return self.session["id"]
+
+    def matches(self, path: str) -> bool:
+        session = self.session
+        if not self.armed or session is None or session["requests_remaining"] <= 0:
+            return False
+        if session["deadline"] and time.monotonic() > session["deadline"]:
+            return False
+        return not session["route"] or path.startswith(session["route"])
+
+    def enter(self) -> dict:
+        # Requests keep their own session: stop() may clear or replace self.session before they finish
+        session = self.session
+        session["active"] += 1
+        session["requests_remaining"] -= 1
+        return session
+
+    def exit(self, session: dict):
+        session["active"] -= 1
+        session["requests_profiled"] += 1
+
+    def exhausted(self, session: dict) -> bool:
+        if self.session is not session:
+            return False
+        expired = session["deadline"] is not None and time.monotonic() > session["deadline"]
+        return session["active"] == 0 and (session["requests_remaining"] <= 0 or expired)
+
+    def stop(self, session: Optional[dict] = None) -> Optional[dict]:
+        """Disarm and return the current session; with `session`, only if it is still the current one"""
+        with self._lock:
+            current = self.session
+            if session is not None and current is not session:
+                return None
+            self.session, self.armed = None, False
+        return current
+
+    def _sample_loop(self, session: dict):
+        while self.session is session:
+            time.sleep(session["interval"])
+            if session["active"] <= 0:
+                continue
+            frame = sys._current_frames().get(session["loop_thread_id"])
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({Path(code.co_filename).name}:{frame.f_lineno})")
+                frame = frame.f_back
+            key = ";".join(reversed(stack))
+            session["stacks"][key] = session["stacks"].get(key, 0) + 1
+            session["samples"] += 1
+
+profiler = SamplingProfiler()
+
+async def save_profile(session: dict):
+    # Let the sampler thread see the session ended before reading its samples
+    await asyncio.to_thread(session["thread"].join)
+    stacks = sorted(session["stacks"].items(), key=lambda item: item[1], reverse=True)[:PROFILE_MAX_STACKS]
+    await db.profiles.insert_one({
+        "_id": session["id"],
+        "route": session["route"],
+        "started_at": session["started_at"],
+        "ended_at": utcnow(),
+        "requests_profiled": session["requests_profiled"],
+        "samples": session["samples"],
+        "interval_ms": int(session["interval"] * 1000),
+        "collapsed": "\n".join(f"{stack} {count}" for stack, count in stacks)
+    })
+    logger.info(f"Perfil {session['id']} guardado ({session['samples']} muestras)")
+
+async def finish_profiling(session: Optional[dict] = None):
+    session = profiler.stop(session)
+    if session:
+        await save_profile(session)
+
+class ProfilerMiddleware:
+    """Plain ASGI middleware: disarmed, it costs one attribute check per request"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not profiler.armed or not profiler.matches(scope["path"]):
+            await self.app(scope, receive, send)
+            return
+        session = profiler.enter()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            profiler.exit(session)
+            if profiler.exhausted(session):
+                await finish_profiling(session)
+
+app.add_middleware(ProfilerMiddleware)
+
 # ===================== AUTH ENDPOINTS =====================
 
 @api_router.post("/auth/register")
 async def register(user_data: UserCreate):
-    existing = await db.users.find_one({"email": user_data.email}, {"_id": 0})
-    if existing:
+    user = User(email=user_data.email)
+    if not email_index_ready and await db.users.find_one({"email": user.email}, {"_id": 1}):
         raise HTTPException(status_code=400, detail="Este email ya está registrado")
     
-    # Check if this is the first user (make admin)
-    user_count = await db.users.count_documents({})
-    is_admin = user_count == 0
+    # First user becomes admin
+    is_admin = await claim_first_admin(user.id)
+    user.is_admin = is_admin
     
-    user = User(email=user_data.email, is_admin=is_admin)
-    await db.users.insert_one(user.model_dump())
-    
-    # Create verification token
+    # Write user and verification token together; the unique email index detects duplicates
     verification = VerificationToken(user_id=user.id)
-    await db.verification_tokens.insert_one(verification.model_dump())
+    user_result, token_result, config = await asyncio.gather(
+        db.users.insert_one(dates_to_storage(user.model_dump(), USER_DATE_FIELDS)),
+        db.verification_tokens.insert_one(dates_to_storage(verification.model_dump(), VERIFICATION_TOKEN_DATE_FIELDS)),
+        get_app_config(),
+        return_exceptions=True
+    )
+    failure = next((r for r in (user_result, token_result, config) if isinstance(r, BaseException)), None)
+    if failure is not None:
+        # Undo whichever write succeeded so the email can register again
+        await asyncio.gather(
+            db.users.delete_one({"id": user.id}),
+            db.verification_tokens.delete_one({"token": verification.token})
+        )
+        if is_admin:
+            await release_first_admin(user.id)
+        if isinstance(user_result, duplicate_key_error()):
+            raise HTTPException(status_code=400, detail="Este email ya está registrado")
+        raise failure
     
     # Get frontend URL from request or use default
     frontend_url = os.environ.get("FRONTEND_URL", "https://smarttasks-15.preview.emergentagent.com")
-    email_result = await send_verification_email(user.email, verification.token, frontend_url)
+    email_result = await send_verification_email(user.email, verification.token, frontend_url, config=config)
     
     response = {
         "message": "Usuario registrado. Por favor verifica tu email.",
@@ -238,8 +1202,7 @@ async def verify_email(request: SetPasswordRequest):
         raise HTTPException(status_code=400, detail="Token de verificación inválido")
     
     # Check expiration
-    expires_at = datetime.fromisoformat(token_doc["expires_at"])
-    if datetime.now(timezone.utc) > expires_at:
+    if utcnow() > to_storage_datetime(token_doc["expires_at"]):
         raise HTTPException(status_code=400, detail="Token expirado")
     
     # Update user
@@ -275,6 +1238,9 @@ async def login(user_data: UserLogin):
     if not user.get("is_verified"):
         raise HTTPException(status_code=401, detail="Por favor verifica tu email primero")
     
+    if user.get("is_disabled"):
+        raise HTTPException(status_code=403, detail="Usuario deshabilitado")
+    
     if not user.get("password_hash") or not verify_password(user_data.password, user["password_hash"]):
         raise HTTPException(status_code=401, detail="Credenciales inválidas")
     
@@ -289,7 +1255,7 @@ async def login(user_data: UserLogin):
     }
 
 @api_router.get("/auth/me")
-async def get_me(user: dict = Depends(get_current_user)):
+async def get_me(user: dict = Depends(get_current_identity)):
     return {
         "id": user["id"],
         "email": user["email"],
@@ -309,7 +1275,7 @@ async def get_config(user: dict = Depends(get_admin_user)):
 @api_router.put("/config")
 async def update_config(config_update: ConfigUpdate, user: dict = Depends(get_admin_user)):
     update_data = {k: v for k, v in config_update.model_dump().items() if v is not None}
-    update_data["updated_at"] = datetime.now(timezone.utc).isoformat()
+    update_data["updated_at"] = utcnow()
     
     await db.app_config.update_one(
         {"id": "app_config"},
@@ -319,6 +1285,21 @@ async def update_config(config_update: ConfigUpdate, user: dict = Depends(get_ad
     
     return {"message": "Configuración actualizada"}
 
+@api_router.put("/admin/users/{user_id}/status")
+async def update_user_status(user_id: str, status_update: UserStatusUpdate, user: dict = Depends(get_admin_user)):
+    """Enable or disable a user; disabling also revokes their issued tokens"""
+    result = await db.users.update_one({"id": user_id}, {"$set": {"is_disabled": status_update.is_disabled}})
+    if result.matched_count == 0:
+        raise HTTPException(status_code=404, detail="Usuario no encontrado")
+    if status_update.is_disabled:
+        await revoke_user_tokens(user_id)
+    return {"message": "Usuario deshabilitado" if status_update.is_disabled else "Usuario habilitado"}
+
+@api_router.post("/admin/users/{user_id}/revoke-tokens")
+async def revoke_tokens(user_id: str, user: dict = Depends(get_admin_user)):
+    await revoke_user_tokens(user_id)
+    return {"message": "Tokens revocados"}
+
 @api_router.get("/config/status")
 async def get_config_status():
     """Public endpoint to check if email is configured"""
@@ -330,244 +1311,524 @@ async def get_config_status():
 
 # ===================== TASK ENDPOINTS =====================
 
+TASK_SORT_FIELDS = {"created_at", "analyzed_at", "name", "impact", "risk", "effort"}
+
 @api_router.get("/tasks", response_model=List[Task])
-async def get_tasks(user: dict = Depends(get_current_user)):
-    tasks = await db.tasks.find({"user_id": user["id"]}, {"_id": 0}).to_list(1000)
-    return tasks
+async def get_tasks(
+    decision: Optional[str] = None,
+    frequency: Optional[str] = None,
+    confidentiality: Optional[str] = None,
+    analyzed: Optional[bool] = None,
+    min_impact: Optional[int] = Query(None, ge=1, le=5),
+    max_impact: Optional[int] = Query(None, ge=1, le=5),
+    min_risk: Optional[int] = Query(None, ge=1, le=5),
+    max_risk: Optional[int] = Query(None, ge=1, le=5),
+    min_effort: Optional[int] = Query(None, ge=1, le=5),
+    max_effort: Optional[int] = Query(None, ge=1, le=5),
+    q: Optional[str] = None,
+    sort: str = "created_at",
+    skip: int = Query(0, ge=0),
+    limit: int = Query(1000, ge=1, le=1000),
+    user: dict = Depends(get_current_identity)
+):
+    """List tasks; all filtering, text search and sorting happen in MongoDB"""
+    query = {"user_id": user["id"]}
+    if decision:
+        # Comma separated list, e.g. decision=C,D
+        decisions = decision.split(",")
+        query["decision"] = decisions[0] if len(decisions) == 1 else {"$in": decisions}
+    if frequency:
+        query["frequency"] = enum_filter(frequency, FREQUENCY_CODES)
+    if confidentiality:
+        query["confidentiality"] = enum_filter(confidentiality, CONFIDENTIALITY_CODES)
+    if analyzed is False and decision:
+        raise HTTPException(status_code=400, detail="No se puede combinar decision con analyzed=false")
+    if analyzed is not None:
+        query["decision"] = query.get("decision", {"$ne": None}) if analyzed else None
+    for field, low, high in (("impact", min_impact, max_impact),
+                             ("risk", min_risk, max_risk),
+                             ("effort", min_effort, max_effort)):
+        score_range = {}
+        if low is not None:
+            score_range["$gte"] = low
+        if high is not None:
+            score_range["$lte"] = high
+        if score_range:
+            query[field] = score_range
+
+    projection = dict(TASK_PROJECTION)
+    if q:
+        query["$text"] = {"$search": q}
+
+    sort_field = sort.lstrip("-")
+    if q and sort_field == "relevance":
+        projection = {**projection, "score": {"$meta": "textScore"}}
+        sort_spec = [("score", {"$meta": "textScore"})]
+    elif sort_field in TASK_SORT_FIELDS:
+        sort_spec = [(sort_field, -1 if sort.startswith("-") else 1)]
+    else:
+        raise HTTPException(status_code=400, detail=f"Orden no soportado: {sort}")
+
+    tasks = await db.tasks.find(query, projection).sort(sort_spec).skip(skip).to_list(limit)
+    return [task_from_storage(task) for task in tasks]
 
 @api_router.post("/tasks", response_model=Task)
-async def create_task(task_data: TaskCreate, user: dict = Depends(get_current_user)):
-    task = Task(user_id=user["id"], **task_data.model_dump())
-    await db.tasks.insert_one(task.model_dump())
-    return task
+async def create_task(task_data: TaskCreate, idempotency_key: Optional[str] = Header(None),
+                      user: dict = Depends(get_current_identity)):
+    async def create():
+        task = Task(user_id=user["id"], **task_data.model_dump())
+        await db.tasks.insert_one({**new_task_document(task), **similarity_fields(task.name, task.description)})
+        await record_task_change(user["id"], task.id, "upsert", task.model_dump(), task.model_dump())
+        await record_daily_metrics({"tasks_created": 1})
+        return task.model_dump()
+    
+    request_hash = hashlib.sha256(task_data.model_dump_json().encode()).hexdigest()
+    return await run_idempotent(user["id"], "create_task", idempotency_key, request_hash, create)
+
+@api_router.get("/tasks/changes")
+async def get_task_changes(since: Optional[int] = Query(None, ge=0), limit: int = Query(500, ge=1, le=1000),
+                           user: dict = Depends(get_current_identity)):
+    """Task deltas after sequence number `since`.
+
+    `reset` means the client is too far behind (or has no state yet) and must
+    reload GET /tasks, then continue from the returned `seq`.
+    """
+    counter = await db.counters.find_one({"_id": f"task_changes:{user['id']}"})
+    latest = counter["seq"] if counter else 0
+    if since is None or since > latest:
+        return {"changes": [], "seq": latest, "reset": True, "has_more": False}
+
+    changes = await db.task_changes.find(
+        {"user_id": user["id"], "seq": {"$gt": since}},
+        {"_id": 0, "user_id": 0, "fields": 0}
+    ).sort("seq", 1).to_list(limit)
+    page_full = len(changes) == limit
+    if (not changes or changes[0]["seq"] != since + 1) and since + 1 <= latest - TASK_CHANGE_LOG_LIMIT:
+        # The entries right after `since` were trimmed from the log
+        return {"changes": [], "seq": latest, "reset": True, "has_more": False}
+
+    # A sequence number is reserved before its entry is inserted, so concurrent
+    # writes can show up out of order: stop at the first gap and let the next
+    # poll pick it up, unless it is too old to still be in flight
+    gap_cutoff = utcnow() - timedelta(seconds=TASK_CHANGE_GAP_GRACE_SECONDS)
+    expected, gap = since + 1, False
+    for i, change in enumerate(changes):
+        if change["seq"] != expected and to_storage_datetime(change["at"]) > gap_cutoff:
+            changes, gap = changes[:i], True
+            break
+        expected = change["seq"] + 1
+    for change in changes:
+        change["task"] = task_from_storage(change["task"])
+
+    seq = changes[-1]["seq"] if changes else since
+    if not gap and not page_full and seq < latest:
+        # The newest numbers have no entry: still being written, or lost if
+        # their reservation is older than the grace period
+        reserved_at = to_storage_datetime(counter.get("reserved_at"))
+        if not reserved_at or reserved_at <= gap_cutoff:
+            seq = latest
+    # Only a full page means there is more to read right away
+    has_more = not gap and page_full and since < seq < latest
+    return {"changes": changes, "seq": seq, "reset": False, "has_more": has_more}
 
 @api_router.get("/tasks/{task_id}", response_model=Task)
-async def get_task(task_id: str, user: dict = Depends(get_current_user)):
-    task = await db.tasks.find_one({"id": task_id, "user_id": user["id"]}, {"_id": 0})
+async def get_task(task_id: str, user: dict = Depends(get_current_identity)):
+    task = await db.tasks.find_one({"id": task_id, "user_id": user["id"]}, TASK_PROJECTION)
     if not task:
         raise HTTPException(status_code=404, detail="Tarea no encontrada")
-    return task
+    return task_from_storage(task)
+
+@api_router.get("/tasks/{task_id}/similar")
+async def get_similar_tasks(task_id: str, threshold: Optional[float] = Query(None, le=1),
+                            user: dict = Depends(get_current_identity)):
+    """Near-duplicate tasks that already have an analysis that could be reused"""
+    task = await db.tasks.find_one({"id": task_id, "user_id": user["id"]}, {"_id": 0, "lsh_bands": 0})
+    if not task:
+        raise HTTPException(status_code=404, detail="Tarea no encontrada")
+    matches = await find_similar_analyzed_tasks(task, user["id"], threshold=threshold)
+    for match in matches:
+        match["task"] = task_from_storage(match["task"])
+        # Only expose the analysis of other users' tasks, not their content
+        if match["task"]["user_id"] != user["id"]:
+            match["task"] = {
+                "id": match["task"]["id"],
+                **{f: match["task"].get(f) for f in ANALYSIS_FIELDS if f not in PRIVATE_ANALYSIS_FIELDS}
+            }
+    return {"task_id": task_id, "matches": matches}
+
+@api_router.get("/tasks/{task_id}/history")
+async def get_task_history(task_id: str, user: dict = Depends(get_current_identity)):
+    """Change history of a task, newest first (limited to the retained change log)"""
+    history = await db.task_changes.find(
+        {"user_id": user["id"], "task_id": task_id},
+        {"_id": 0, "user_id": 0, "task": 0}
+    ).sort("seq", -1).to_list(TASK_CHANGE_LOG_LIMIT)
+    for entry in history:
+        entry["fields"] = task_from_storage(entry["fields"])
+    return {"task_id": task_id, "history": history}
 
 @api_router.put("/tasks/{task_id}", response_model=Task)
-async def update_task(task_id: str, task_data: TaskUpdate, user: dict = Depends(get_current_user)):
+async def update_task(task_id: str, task_data: TaskUpdate, user: dict = Depends(get_current_identity)):
     update_data = {k: v for k, v in task_data.model_dump().items() if v is not None}
     if not update_data:
         raise HTTPException(status_code=400, detail="No hay datos para actualizar")
     
-    result = await db.tasks.update_one(
+    if any(field in update_data for field in ANALYSIS_INPUT_FIELDS):
+        existing = task_from_storage(await db.tasks.find_one(
+            {"id": task_id, "user_id": user["id"]},
+            {"_id": 0, "decision": 1, **{field: 1 for field in ANALYSIS_INPUT_FIELDS}}
+        ))
+        if not existing:
+            raise HTTPException(status_code=404, detail="Tarea no encontrada")
+        changed = {f for f in ANALYSIS_INPUT_FIELDS if f in update_data and update_data[f] != existing.get(f)}
+        if changed & {"name", "description"}:
+            update_data.update(similarity_fields(
+                update_data.get("name", existing["name"]),
+                update_data.get("description", existing["description"])
+            ))
+        if changed and existing.get("decision") and "decision" not in update_data:
+            # Queue the now outdated analysis for the background scheduler
+            update_data["needs_reanalysis"] = True
+            update_data["inputs_changed_at"] = utcnow()
+    
+    task = task_from_storage(await db.tasks.find_one_and_update(
         {"id": task_id, "user_id": user["id"]},
-        {"$set": update_data}
-    )
-    if result.matched_count == 0:
+        {"$set": task_to_storage(update_data)},
+        projection=TASK_PROJECTION,
+        return_document=return_after()
+    ))
+    if not task:
         raise HTTPException(status_code=404, detail="Tarea no encontrada")
     
-    task = await db.tasks.find_one({"id": task_id}, {"_id": 0})
+    await record_task_change(user["id"], task_id, "upsert", task, update_data)
     return task
 
 @api_router.delete("/tasks/{task_id}")
-async def delete_task(task_id: str, user: dict = Depends(get_current_user)):
+async def delete_task(task_id: str, user: dict = Depends(get_current_identity)):
     result = await db.tasks.delete_one({"id": task_id, "user_id": user["id"]})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Tarea no encontrada")
+    await record_task_change(user["id"], task_id, "delete")
     return {"message": "Tarea eliminada"}
 
 # ===================== AI ANALYSIS ENDPOINT =====================
 
-@api_router.post("/tasks/{task_id}/analyze")
-async def analyze_task(task_id: str, user: dict = Depends(get_current_user)):
-    from emergentintegrations.llm.chat import LlmChat, UserMessage
-    
-    task = await db.tasks.find_one({"id": task_id, "user_id": user["id"]}, {"_id": 0})
-    if not task:
-        raise HTTPException(status_code=404, detail="Tarea no encontrada")
-    
-    api_key = os.environ.get("EMERGENT_LLM_KEY")
-    if not api_key:
-        raise HTTPException(status_code=500, detail="API key no configurada")
-    
-    prompt = f"""Analiza esta tarea empresarial y proporciona una recomendación estructurada.
-
-TAREA:
-- Nombre: {task['name']}
-- Descripción: {task['description']}
-- Frecuencia: {task['frequency']}
-- Duración estimada: {task['duration']}
-- Impacto actual (si proporcionado): {task.get('impact', 'No especificado')}
-- Riesgo actual (si proporcionado): {task.get('risk', 'No especificado')}
-- Esfuerzo actual (si proporcionado): {task.get('effort', 'No especificado')}
-- Confidencialidad actual (si proporcionado): {task.get('confidentiality', 'No especificado')}
+# (task_id, input hash) -> shared future of the running analysis
+_inflight_analyses: dict = {}
+
+async def _analyze_and_store(task: dict, user_id: str) -> dict:
+    update_data = await run_task_analysis(task)
+    update_data.update(missing_similarity_fields(task))
+    updated_task = task_from_storage(await db.tasks.find_one_and_update(
+        {"id": task["id"]},
+        {"$set": task_to_storage(update_data)},
+        projection=TASK_PROJECTION,
+        return_document=return_after()
+    ))
+    await record_task_change(user_id, task["id"], "upsert", updated_task, update_data)
+    return updated_task
+
+async def analyze_and_store(task: dict, user_id: str) -> dict:
+    """Analyze a task and persist the result.
+
+    Concurrent requests for the same task and inputs (double clicks, retries,
+    analyze-all overlapping a single analyze) share one LLM call and result.
+    """
+    key = (task["id"], hashlib.sha256(build_analysis_prompt(task).encode()).hexdigest())
+    inflight = _inflight_analyses.get(key)
+    if inflight is None:
+        inflight = asyncio.ensure_future(_analyze_and_store(task, user_id))
+        _inflight_analyses[key] = inflight
+        inflight.add_done_callback(lambda _: _inflight_analyses.pop(key, None))
+    # Shielded so a disconnecting caller doesn't cancel the call for the others
+    return await asyncio.shield(inflight)
 
-REGLAS DE DECISIÓN (aplica en este orden de prioridad):
-
-1. CONSERVAR (C): Cuando Riesgo ≥ 4 O Confidencialidad = Alta
-   - Tareas críticas que el dueño debe mantener temporalmente
-
-2. DELEGAR (D): Cuando Esfuerzo ≥ 3 Y Impacto ≥ 3 Y Riesgo ≤ 3
-   - Tareas que pueden asignarse a otros
-
-3. AUTOMATIZAR (A): Cuando es tarea recurrente (frecuencia alta) Y proceso repetitivo con reglas claras
-   - Tareas que pueden sistematizarse
-
-4. ELIMINAR (E): Cuando Impacto ≤ 2 Y no tiene vínculo claro con objetivos del negocio
-   - Tareas que no agregan valor
-
-PERFILES PARA DELEGACIÓN:
-- Prospección comercial → Agencia externa (10-20 hrs/sem)
-- Pagos y conciliaciones → Administrativo interno (2-4 hrs/sem)
-- Marketing y redes sociales → Community Manager o Agencia externa (4-8 hrs/sem)
-- Legal y contratos → Estudio jurídico externo (2-4 hrs/sem)
-- Contabilidad e impuestos → Estudio contable externo (4-8 hrs/sem)
-
-Responde ÚNICAMENTE en formato JSON con esta estructura exacta:
-{{
-    "impact": <número 1-5>,
-    "risk": <número 1-5>,
-    "effort": <número 1-5>,
-    "confidentiality": "<Baja|Media|Alta>",
-    "decision": "<C|D|A|E>",
-    "decision_justification": "<explicación breve en español de por qué esta decisión>",
-    "suggested_profile": "<perfil sugerido si es D, null si no>",
-    "suggested_hours": "<horas sugeridas si es D, null si no>"
-}}"""
-
-    try:
-        chat = LlmChat(
-            api_key=api_key,
-            session_id=f"task-analysis-{task_id}",
-            system_message="Eres un consultor empresarial experto en optimización de tiempo y delegación de tareas para PyMEs. Responde siempre en español y en formato JSON."
-        ).with_model("openai", "gpt-4o")
-        
-        response = await chat.send_message(UserMessage(text=prompt))
-        
-        # Parse JSON response
-        import json
-        # Clean response if needed
-        response_text = response.strip()
-        if response_text.startswith("```json"):
-            response_text = response_text[7:]
-        if response_text.startswith("```"):
-            response_text = response_text[3:]
-        if response_text.endswith("```"):
-            response_text = response_text[:-3]
-        
-        analysis = json.loads(response_text.strip())
-        
-        # Update task with analysis results
-        update_data = {
-            "impact": analysis.get("impact"),
-            "risk": analysis.get("risk"),
-            "effort": analysis.get("effort"),
-            "confidentiality": analysis.get("confidentiality"),
-            "decision": analysis.get("decision"),
-            "decision_justification": analysis.get("decision_justification"),
-            "suggested_profile": analysis.get("suggested_profile"),
-            "suggested_hours": analysis.get("suggested_hours"),
-            "analyzed_at": datetime.now(timezone.utc).isoformat()
-        }
+@api_router.post("/tasks/{task_id}/analyze")
+async def analyze_task(task_id: str, reuse: bool = True, idempotency_key: Optional[str] = Header(None),
+                       user: dict = Depends(get_current_identity)):
+    async def analyze():
+        task = task_from_storage(await db.tasks.find_one({"id": task_id, "user_id": user["id"]}, {"_id": 0, "lsh_bands": 0}))
+        if not task:
+            raise HTTPException(status_code=404, detail="Tarea no encontrada")
         
-        await db.tasks.update_one({"id": task_id}, {"$set": update_data})
+        # Reuse the analysis of a near-duplicate task instead of a new LLM call
+        if reuse:
+            reused_task = await reuse_similar_analysis(task, user["id"])
+            if reused_task:
+                return reused_task
         
-        updated_task = await db.tasks.find_one({"id": task_id}, {"_id": 0})
-        return updated_task
+        if not os.environ.get("EMERGENT_LLM_KEY"):
+            raise HTTPException(status_code=500, detail="API key no configurada")
         
-    except json.JSONDecodeError as e:
-        logger.error(f"Error parsing AI response: {e}")
-        raise HTTPException(status_code=500, detail="Error procesando respuesta de IA")
-    except Exception as e:
-        logger.error(f"Error analyzing task: {e}")
-        raise HTTPException(status_code=500, detail=f"Error analizando tarea: {str(e)}")
+        global _interactive_analyses
+        _interactive_analyses += 1
+        try:
+            return await analyze_and_store(task, user["id"])
+        except json.JSONDecodeError as e:
+            logger.error(f"Error parsing AI response: {e}")
+            raise HTTPException(status_code=500, detail="Error procesando respuesta de IA")
+        except Exception as e:
+            logger.error(f"Error analyzing task: {e}")
+            raise HTTPException(status_code=500, detail=f"Error analizando tarea: {str(e)}")
+        finally:
+            _interactive_analyses -= 1
+    
+    return await run_idempotent(user["id"], f"analyze:{task_id}", idempotency_key, f"reuse={reuse}", analyze)
 
 @api_router.post("/tasks/analyze-all")
-async def analyze_all_tasks(user: dict = Depends(get_current_user)):
-    tasks = await db.tasks.find({"user_id": user["id"]}, {"_id": 0}).to_list(1000)
+async def analyze_all_tasks(reuse: bool = True, user: dict = Depends(get_current_identity)):
+    tasks = await db.tasks.find({"user_id": user["id"]}, {"_id": 0, "lsh_bands": 0}).to_list(1000)
+    tasks = [task_from_storage(task) for task in tasks]
     results = []
     
-    for task in tasks:
-        try:
-            # Reuse the analyze endpoint logic
-            from emergentintegrations.llm.chat import LlmChat, UserMessage
-            import json
-            
-            api_key = os.environ.get("EMERGENT_LLM_KEY")
-            
-            prompt = f"""Analiza esta tarea empresarial y proporciona una recomendación estructurada.
-
-TAREA:
-- Nombre: {task['name']}
-- Descripción: {task['description']}
-- Frecuencia: {task['frequency']}
-- Duración estimada: {task['duration']}
-
-REGLAS DE DECISIÓN:
-1. CONSERVAR (C): Riesgo ≥ 4 O Confidencialidad = Alta
-2. DELEGAR (D): Esfuerzo ≥ 3 Y Impacto ≥ 3 Y Riesgo ≤ 3
-3. AUTOMATIZAR (A): Tarea recurrente Y proceso repetitivo
-4. ELIMINAR (E): Impacto ≤ 2 Y sin vínculo con objetivos
-
-Responde ÚNICAMENTE en JSON:
-{{"impact": <1-5>, "risk": <1-5>, "effort": <1-5>, "confidentiality": "<Baja|Media|Alta>", "decision": "<C|D|A|E>", "decision_justification": "<explicación>", "suggested_profile": "<perfil o null>", "suggested_hours": "<horas o null>"}}"""
-
-            chat = LlmChat(
-                api_key=api_key,
-                session_id=f"task-analysis-{task['id']}",
-                system_message="Eres un consultor empresarial. Responde en español y JSON."
-            ).with_model("openai", "gpt-4o")
-            
-            response = await chat.send_message(UserMessage(text=prompt))
-            response_text = response.strip()
-            if response_text.startswith("```json"):
-                response_text = response_text[7:]
-            if response_text.startswith("```"):
-                response_text = response_text[3:]
-            if response_text.endswith("```"):
-                response_text = response_text[:-3]
-            
-            analysis = json.loads(response_text.strip())
-            
-            update_data = {
-                "impact": analysis.get("impact"),
-                "risk": analysis.get("risk"),
-                "effort": analysis.get("effort"),
-                "confidentiality": analysis.get("confidentiality"),
-                "decision": analysis.get("decision"),
-                "decision_justification": analysis.get("decision_justification"),
-                "suggested_profile": analysis.get("suggested_profile"),
-                "suggested_hours": analysis.get("suggested_hours"),
-                "analyzed_at": datetime.now(timezone.utc).isoformat()
-            }
+    global _interactive_analyses
+    _interactive_analyses += 1
+    try:
+        for task in tasks:
+            try:
+                if reuse and await reuse_similar_analysis(task, user["id"]):
+                    results.append({"task_id": task['id'], "status": "success", "reused": True})
+                    continue
             
-            await db.tasks.update_one({"id": task['id']}, {"$set": update_data})
-            results.append({"task_id": task['id'], "status": "success"})
+                await analyze_and_store(task, user["id"])
+                results.append({"task_id": task['id'], "status": "success"})
             
-        except Exception as e:
-            logger.error(f"Error analyzing task {task['id']}: {e}")
-            results.append({"task_id": task['id'], "status": "error", "error": str(e)})
+            except Exception as e:
+                logger.error(f"Error analyzing task {task['id']}: {e}")
+                results.append({"task_id": task['id'], "status": "error", "error": str(e)})
+    finally:
+        _interactive_analyses -= 1
     
     return {"results": results, "total": len(tasks), "success": sum(1 for r in results if r["status"] == "success")}
 
+# ===================== REANALYSIS SCHEDULER =====================
+
+# Interactive analyses in flight in this worker; bulk catch-up yields to them
+_interactive_analyses = 0
+
+def stale_analysis_queries() -> List[tuple]:
+    """(query, sort) pairs in priority order: edited tasks first, then old prompt/model versions"""
+    return [
+        ({"needs_reanalysis": True, "decision": {"$ne": None}}, [("inputs_changed_at", 1)]),
+        ({"decision": {"$ne": None}, "analysis_version": {"$ne": ANALYSIS_VERSION}}, [("analyzed_at", 1)]),
+    ]
+
+async def claim_stale_task() -> Optional[dict]:
+    """Lease the highest priority stale task so concurrent workers don't pick the same one"""
+    now = utcnow()
+    lease_free = {"$or": [{"reanalysis_lease_until": None}, {"reanalysis_lease_until": {"$lt": now}}]}
+    for query, sort in stale_analysis_queries():
+        task = await db.tasks.find_one_and_update(
+            {**query, **lease_free},
+            {"$set": {"reanalysis_lease_until": now + timedelta(minutes=REANALYSIS_LEASE_MINUTES)}},
+            projection={"_id": 0, "lsh_bands": 0},
+            sort=sort,
+            return_document=return_after()
+        )
+        if task:
+            return task
+    return None
+
+async def reanalyze_stale_task(task: dict):
+    inputs_changed_at = task.get("inputs_changed_at")
+    update_data = await run_task_analysis(task_from_storage(task))
+    update_data.update(missing_similarity_fields(task))
+    # Only store the result if the task wasn't edited again while the LLM was running
+    updated_task = task_from_storage(await db.tasks.find_one_and_update(
+        {"id": task["id"], "inputs_changed_at": inputs_changed_at},
+        {"$set": task_to_storage(update_data), "$unset": {"reanalysis_lease_until": "", "reanalysis_attempts": ""}},
+        projection=TASK_PROJECTION,
+        return_document=return_after()
+    ))
+    if updated_task:
+        await record_task_change(task["user_id"], task["id"], "upsert", updated_task, update_data)
+    else:
+        await db.tasks.update_one({"id": task["id"]}, {"$unset": {"reanalysis_lease_until": ""}})
+
+async def run_reanalysis_batch() -> int:
+    processed = 0
+    while processed < REANALYSIS_BATCH_SIZE:
+        # Idle capacity only: wait while users are waiting on their own analyses
+        while _interactive_analyses > 0:
+            await asyncio.sleep(1)
+        task = await claim_stale_task()
+        if not task:
+            break
+        try:
+            await reanalyze_stale_task(task)
+        except Exception as e:
+            # Keep the lease with exponential backoff so a task that always fails
+            # doesn't take every slot of every batch
+            attempts = task.get("reanalysis_attempts", 0) + 1
+            backoff = min(REANALYSIS_LEASE_MINUTES * 2 ** (attempts - 1), REANALYSIS_MAX_BACKOFF_MINUTES)
+            logger.error(f"Error re-analizando tarea {task['id']} (intento {attempts}, reintento en {backoff} min): {e}")
+            await db.tasks.update_one(
+                {"id": task["id"]},
+                {"$set": {"reanalysis_attempts": attempts, "reanalysis_lease_until": utcnow() + timedelta(minutes=backoff)}}
+            )
+        processed += 1
+        await asyncio.sleep(REANALYSIS_CALL_SPACING_SECONDS)
+    return processed
+
+async def reanalysis_scheduler():
+    while True:
+        try:
+            processed = await run_reanalysis_batch()
+            if processed:
+                logger.info(f"Re-análisis en segundo plano: {processed} tareas")
+        except Exception as e:
+            logger.error(f"Error en el scheduler de re-análisis: {e}")
+        await asyncio.sleep(REANALYSIS_INTERVAL_SECONDS)
+
 # ===================== REPORT ENDPOINT =====================
 
 @api_router.get("/report")
-async def get_report(user: dict = Depends(get_current_user)):
-    tasks = await db.tasks.find({"user_id": user["id"]}, {"_id": 0}).to_list(1000)
-    
-    total = len(tasks)
-    analyzed = [t for t in tasks if t.get("decision")]
+async def get_report(include_tasks: bool = True, user: dict = Depends(get_current_identity)):
+    """Decision summary; include_tasks=false returns only the counts (the Report page lists rows via GET /tasks)"""
+    if include_tasks:
+        tasks = await db.tasks.find({"user_id": user["id"]}, TASK_PROJECTION).to_list(1000)
+        tasks = [task_from_storage(task) for task in tasks]
+        counts = {}
+        for task in tasks:
+            counts[task.get("decision")] = counts.get(task.get("decision"), 0) + 1
+    else:
+        groups = await db.tasks.aggregate([
+            {"$match": {"user_id": user["id"]}},
+            {"$group": {"_id": "$decision", "count": {"$sum": 1}}}
+        ]).to_list(None)
+        counts = {group["_id"]: group["count"] for group in groups}
     
+    total = sum(counts.values())
     stats = {
         "total": total,
-        "analyzed": len(analyzed),
-        "conservar": len([t for t in analyzed if t.get("decision") == "C"]),
-        "delegar": len([t for t in analyzed if t.get("decision") == "D"]),
-        "automatizar": len([t for t in analyzed if t.get("decision") == "A"]),
-        "eliminar": len([t for t in analyzed if t.get("decision") == "E"])
+        "analyzed": total - counts.get(None, 0),
+        "conservar": counts.get("C", 0),
+        "delegar": counts.get("D", 0),
+        "automatizar": counts.get("A", 0),
+        "eliminar": counts.get("E", 0)
     }
     
+    if not include_tasks:
+        return {"stats": stats}
     return {
         "stats": stats,
         "tasks": tasks
     }
 
+# ===================== ADMIN ANALYTICS ENDPOINTS =====================
+
+@api_router.get("/admin/analytics")
+async def get_admin_analytics(days: int = Query(30, ge=1, le=365), user: dict = Depends(get_admin_user)):
+    """Platform-wide daily rollups, read from the precomputed analytics_daily buckets.
+
+    Token counters are local estimates (see run_task_analysis), not provider-reported usage.
+    """
+    since = (datetime.now(timezone.utc) - timedelta(days=days - 1)).strftime("%Y-%m-%d")
+    buckets = await db.analytics_daily.find({"_id": {"$gte": since}}).sort("_id", 1).to_list(days)
+
+    daily = []
+    totals = {
+        "tasks_created": 0, "analyses": 0, "analyses_reused": 0,
+        "llm_calls": 0, "llm_failures": 0, "input_tokens": 0, "output_tokens": 0
+    }
+    decisions = {"C": 0, "D": 0, "A": 0, "E": 0}
+    for bucket in buckets:
+        day = {"date": bucket["_id"], "decisions": bucket.get("decisions", {})}
+        for key in totals:
+            day[key] = bucket.get(key, 0)
+            totals[key] += day[key]
+        for decision, count in day["decisions"].items():
+            decisions[decision] = decisions.get(decision, 0) + count
+        daily.append(day)
+
+    return {"days": days, "daily": daily, "totals": totals, "decisions": decisions, "tokens_estimated": True}
+
+@api_router.post("/admin/analytics/rebuild")
+async def rebuild_admin_analytics(request: AnalyticsRebuildRequest, user: dict = Depends(get_admin_user)):
+    """Backfill daily buckets from existing tasks (e.g. history from before rollups existed)"""
+    updated = await rebuild_daily_analytics(request.days)
+    return {"message": "Analíticas recalculadas", "buckets": updated}
+
+@api_router.get("/admin/reanalysis")
+async def get_reanalysis_status(user: dict = Depends(get_admin_user)):
+    """Backlog of analyses waiting for the background scheduler"""
+    changed_query, stale_query = (query for query, _ in stale_analysis_queries())
+    changed, outdated = await asyncio.gather(
+        db.tasks.count_documents(changed_query),
+        db.tasks.count_documents(stale_query)
+    )
+    return {
+        "enabled": REANALYSIS_ENABLED,
+        "analysis_version": ANALYSIS_VERSION,
+        "changed": changed,
+        "outdated_version": outdated
+    }
+
+# ===================== ADMIN PROFILER ENDPOINTS =====================
+
+@api_router.post("/admin/profiler")
+async def start_profiler(request: ProfilerStart, user: dict = Depends(get_admin_user)):
+    """Profile the next N matching requests (or a time window) on the worker that receives this call"""
+    profile_id = profiler.start(request.requests, request.seconds, request.route, request.interval_ms)
+    if request.seconds:
+        async def stop_at_deadline():
+            await asyncio.sleep(request.seconds)
+            session = profiler.session
+            if session and session["id"] == profile_id and session["active"] == 0:
+                await finish_profiling(session)
+        asyncio.create_task(stop_at_deadline())
+    return {"message": "Profiler activado", "profile_id": profile_id}
+
+@api_router.get("/admin/profiler")
+async def get_profiler_status(user: dict = Depends(get_admin_user)):
+    session = profiler.session
+    if not session:
+        return {"armed": False}
+    return {
+        "armed": True,
+        "profile_id": session["id"],
+        "route": session["route"],
+        "requests_remaining": session["requests_remaining"],
+        "requests_profiled": session["requests_profiled"],
+        "samples": session["samples"]
+    }
+
+@api_router.delete("/admin/profiler")
+async def stop_profiler(user: dict = Depends(get_admin_user)):
+    session = profiler.stop()
+    if not session:
+        raise HTTPException(status_code=404, detail="El profiler no está activo")
+    await save_profile(session)
+    return {"message": "Profiler detenido", "profile_id": session["id"]}
+
+@api_router.get("/admin/profiler/profiles")
+async def list_profiles(user: dict = Depends(get_admin_user)):
+    profiles = await db.profiles.find({}, {"collapsed": 0}).sort("started_at", -1).to_list(50)
+    return [{"id": p.pop("_id"), **dates_from_storage(p, ("started_at", "ended_at"))} for p in profiles]
+
+@api_router.get("/admin/profiler/profiles/{profile_id}")
+async def download_profile(profile_id: str, user: dict = Depends(get_admin_user)):
+    """Collapsed stacks, ready for flamegraph.pl or speedscope"""
+    profile = await db.profiles.find_one({"_id": profile_id}, {"collapsed": 1})
+    if not profile:
+        raise HTTPException(status_code=404, detail="Perfil no encontrado")
+    return PlainTextResponse(
+        profile["collapsed"],
+        headers={"Content-Disposition": f'attachment; filename="profile-{profile_id}.folded"'}
+    )
+
+# ===================== HEALTH ENDPOINTS =====================
+
+@api_router.get("/health/startup")
+async def get_startup_health():
+    """Readiness plus the import/startup timing breakdown of this worker"""
+    return {
+        "ready": startup_state["ready"],
+        "warm": startup_state["warm"],
+        "time_to_ready": startup_timings.get("time_to_ready"),
+        "timings": startup_timings
+    }
+
 # ===================== ROOT ENDPOINT =====================
 
 @api_router.get("/")
@@ -585,6 +1846,92 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.on_event("startup")
+async def create_indexes():
+    started = time.perf_counter()
+    # Independent index builds run concurrently; one failure doesn't skip the rest
+    results = await asyncio.gather(
+        db.tasks.create_index([("user_id", 1), ("lsh_bands", 1)]),
+        db.tasks.create_index("lsh_bands"),
+        # Server-side task search, filters and sort (GET /tasks)
+        db.tasks.create_index("id", unique=True),
+        db.tasks.create_index([("user_id", 1), ("created_at", 1)]),
+        db.tasks.create_index([("user_id", 1), ("decision", 1), ("created_at", 1)]),
+        db.tasks.create_index([("user_id", 1), ("frequency", 1), ("created_at", 1)]),
+        db.tasks.create_index([("user_id", 1), ("confidentiality", 1), ("created_at", 1)]),
+        db.tasks.create_index(
+            [("user_id", 1), ("name", "text"), ("description", "text")],
+            name="tasks_text_search",
+            default_language="spanish",
+            weights={"name": 3, "description": 1}
+        ),
+        # Admin analytics backfill scans tasks by day
+        db.tasks.create_index("created_at"),
+        db.tasks.create_index("analyzed_at"),
+        db.task_changes.create_index([("user_id", 1), ("seq", 1)], unique=True),
+        db.task_changes.create_index([("user_id", 1), ("task_id", 1), ("seq", -1)]),
+        db.token_revocations.create_index("user_id", unique=True),
+        db.users.create_index("email", unique=True),
+        db.users.create_index("id", unique=True),
+        db.verification_tokens.create_index("token", unique=True),
+        db.token_revocations.create_index("revoked_before"),
+        db.idempotency_keys.create_index("expires_at", expireAfterSeconds=0),
+        db.profiles.create_index("started_at"),
+        db.app_config.create_index("id", unique=True),
+        # Background re-analysis queue
+        db.tasks.create_index(
+            [("needs_reanalysis", 1), ("inputs_changed_at", 1)],
+            partialFilterExpression={"needs_reanalysis": True}
+        ),
+        db.tasks.create_index([("analysis_version", 1), ("analyzed_at", 1)]),
+        # Native dates allow expiring unused verification tokens with a TTL index
+        db.verification_tokens.create_index("expires_at", expireAfterSeconds=0),
+        return_exceptions=True
+    )
+    for result in results:
+        if isinstance(result, Exception):
+            logger.error(f"Error creando índices: {result}")
+    try:
+        await check_email_index()
+    except Exception as e:
+        logger.error(f"Error comprobando el índice users.email: {e}")
+    record_startup_timing("create_indexes", started)
+
+@app.on_event("startup")
+async def start_revocation_refresh():
+    # First load happens on the loop's first iteration; a Mongo outage must not block startup
+    asyncio.create_task(refresh_revocations_periodically())
+
+@app.on_event("startup")
+async def start_reanalysis_scheduler():
+    if REANALYSIS_ENABLED:
+        asyncio.create_task(reanalysis_scheduler())
+
+async def warm_up_integrations():
+    """Load heavy integrations off the event loop so the first request doesn't pay for them"""
+    started = time.perf_counter()
+    for name in WARMUP_MODULES:
+        try:
+            await asyncio.to_thread(lazy_import, name)
+        except Exception as e:
+            logger.warning(f"Warmup de {name} falló: {e}")
+    await asyncio.to_thread(count_tokens, "")
+    record_startup_timing("warmup", started)
+    startup_state["warm"] = True
+
+# Registered last so it runs after every other startup handler
+@app.on_event("startup")
+async def mark_ready():
+    startup_state["ready"] = True
+    startup_timings["time_to_ready"] = round(time.perf_counter() - _MODULE_IMPORT_STARTED, 4)
+    logger.info(f"Listo para servir en {startup_timings['time_to_ready']}s")
+    if STARTUP_WARMUP:
+        asyncio.create_task(warm_up_integrations())
+    else:
+        startup_state["warm"] = True
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
-    client.close()
+    close_mongo_client()
+
+record_startup_timing("module_import", _MODULE_IMPORT_STARTED)
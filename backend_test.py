@@ -1,6 +1,9 @@
 import requests
 import sys
 import json
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
 class SmartTasksAPITester:
@@ -13,6 +16,9 @@ class SmartTasksAPITester:
         self.tests_passed = 0
         self.verification_token = None
         self.task_id = None
+        self.secondary_email = None
+        self.secondary_id = None
+        self.secondary_token = None
 
     def run_test(self, name, method, endpoint, expected_status, data=None, headers=None):
         """Run a single API test"""
@@ -68,6 +74,19 @@ class SmartTasksAPITester:
         )
         return success
 
+    def test_startup_health(self):
+        """Test startup readiness and timing breakdown"""
+        success, response = self.run_test(
+            "Startup Health",
+            "GET",
+            "health/startup",
+            200
+        )
+        if success:
+            print(f"   Ready: {response.get('ready')} (warm: {response.get('warm')})")
+            print(f"   Time to ready: {response.get('time_to_ready')}s")
+        return success
+
     def test_config_status(self):
         """Test public config status endpoint"""
         success, response = self.run_test(
@@ -163,6 +182,45 @@ class SmartTasksAPITester:
             print(f"   Task ID: {self.task_id}")
         return success
 
+    def test_idempotent_create_task(self):
+        """Test that retrying a create with the same Idempotency-Key returns the same task"""
+        task_data = {
+            "name": "Conciliación bancaria",
+            "description": "Conciliar los movimientos bancarios con la contabilidad",
+            "frequency": "Mensual",
+            "duration": "3 horas"
+        }
+        headers = {"Idempotency-Key": str(uuid.uuid4())}
+        results = []
+        success, first = self.run_test("Create Task (Idempotency-Key)", "POST", "tasks", 200, data=task_data, headers=headers)
+        results.append(success)
+        success, retry = self.run_test("Retry Create Task (same key)", "POST", "tasks", 200, data=task_data, headers=headers)
+        results.append(success)
+        if success and first.get('id') != retry.get('id'):
+            print(f"❌ Retry created another task: {first.get('id')} != {retry.get('id')}")
+            results.append(False)
+
+        success, tasks = self.run_test("Get Tasks After Retry", "GET", "tasks", 200)
+        created = [t for t in tasks if t.get('name') == task_data["name"]] if success else []
+        if success and len(created) != 1:
+            print(f"❌ Expected 1 task, found {len(created)}")
+            results.append(False)
+
+        # Same key with a different body is rejected
+        success, _ = self.run_test(
+            "Reuse Idempotency-Key With Other Body",
+            "POST",
+            "tasks",
+            422,
+            data={**task_data, "duration": "4 horas"},
+            headers=headers
+        )
+        results.append(success)
+
+        if first.get('id'):
+            self.run_test("Delete Idempotent Task", "DELETE", f"tasks/{first['id']}", 200)
+        return all(results)
+
     def test_get_tasks(self):
         """Test get all tasks"""
         success, response = self.run_test(
@@ -175,6 +233,30 @@ class SmartTasksAPITester:
             print(f"   Found {len(response)} tasks")
         return success
 
+    def test_search_tasks(self):
+        """Test server-side task search, filters and sort"""
+        success, response = self.run_test(
+            "Search Tasks",
+            "GET",
+            "tasks?q=contratos&min_impact=3&sort=-created_at",
+            200
+        )
+        if success:
+            print(f"   Found {len(response)} matching tasks")
+        return success
+
+    def test_task_changes(self):
+        """Test task change feed (delta sync)"""
+        success, response = self.run_test(
+            "Task Changes",
+            "GET",
+            "tasks/changes?since=0",
+            200
+        )
+        if success:
+            print(f"   Changes: {len(response.get('changes', []))}, seq: {response.get('seq')}, reset: {response.get('reset')}")
+        return success
+
     def test_get_single_task(self):
         """Test get single task"""
         if not self.task_id:
@@ -208,6 +290,22 @@ class SmartTasksAPITester:
         )
         return success
 
+    def test_similar_tasks(self):
+        """Test near-duplicate lookup for a task"""
+        if not self.task_id:
+            print("❌ No task ID available")
+            return False
+            
+        success, response = self.run_test(
+            "Similar Tasks",
+            "GET",
+            f"tasks/{self.task_id}/similar",
+            200
+        )
+        if success:
+            print(f"   Found {len(response.get('matches', []))} near-duplicates")
+        return success
+
     def test_analyze_task(self):
         """Test AI task analysis"""
         if not self.task_id:
@@ -228,6 +326,28 @@ class SmartTasksAPITester:
             print(f"   Justification: {justification[:100]}...")
         return success
 
+    def test_concurrent_analyze_single_flight(self):
+        """Test that concurrent analyses of the same task share one LLM call (per worker)"""
+        if not self.task_id:
+            print("❌ No task ID available")
+            return False
+
+        print("   Note: AI analysis may take 10-15 seconds...")
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            futures = [
+                pool.submit(self.run_test, f"Concurrent Analyze #{i + 1}", "POST", f"tasks/{self.task_id}/analyze?reuse=false", 200)
+                for i in range(2)
+            ]
+            (first_ok, first), (second_ok, second) = [future.result() for future in futures]
+        if not (first_ok and second_ok):
+            return False
+        # One shared call stores a single result; two calls would differ in analyzed_at
+        if first.get('analyzed_at') != second.get('analyzed_at'):
+            print(f"❌ Two LLM calls: analyzed_at {first.get('analyzed_at')} != {second.get('analyzed_at')}")
+            return False
+        print(f"   Shared analysis: {first.get('decision')} at {first.get('analyzed_at')}")
+        return True
+
     def test_analyze_all_tasks(self):
         """Test analyze all tasks"""
         print("   Note: Bulk AI analysis may take 15-30 seconds...")
@@ -298,6 +418,173 @@ class SmartTasksAPITester:
         )
         return success
 
+    def test_admin_analytics(self):
+        """Test admin platform-wide analytics"""
+        if not self.is_admin:
+            print("⚠️  Skipping admin test - user is not admin")
+            return True
+            
+        success, response = self.run_test(
+            "Admin Analytics",
+            "GET",
+            "admin/analytics?days=7",
+            200
+        )
+        if success:
+            totals = response.get('totals', {})
+            print(f"   Tasks created: {totals.get('tasks_created', 0)}")
+            print(f"   Analyses: {totals.get('analyses', 0)}")
+            print(f"   LLM calls: {totals.get('llm_calls', 0)} (failures: {totals.get('llm_failures', 0)})")
+        return success
+
+    def create_secondary_user(self):
+        """Register and verify a second (non-admin) user for the admin auth tests"""
+        self.secondary_email = f"secondary_{datetime.now().strftime('%H%M%S')}@example.com"
+        success, response = self.run_test(
+            "Register Secondary User",
+            "POST",
+            "auth/register",
+            200,
+            data={"email": self.secondary_email}
+        )
+        verification_link = response.get('verification_link') if success else None
+        if not verification_link:
+            print("❌ No verification link for secondary user (email configured?)")
+            return False
+        success, response = self.run_test(
+            "Verify Secondary User",
+            "POST",
+            "auth/verify-email",
+            200,
+            data={"token": verification_link.split('token=')[1], "password": "TestPass123!"}
+        )
+        if success:
+            self.secondary_id = response.get('user', {}).get('id')
+            self.secondary_token = response.get('token')
+        return success
+
+    def login_secondary_user(self, expected_status=200):
+        success, response = self.run_test(
+            "Login Secondary User",
+            "POST",
+            "auth/login",
+            expected_status,
+            data={"email": self.secondary_email, "password": "TestPass123!"}
+        )
+        if success and expected_status == 200:
+            self.secondary_token = response.get('token')
+        return success
+
+    def secondary_request(self, name, endpoint, expected_status):
+        success, _ = self.run_test(
+            name,
+            "GET",
+            endpoint,
+            expected_status,
+            headers={'Authorization': f'Bearer {self.secondary_token}'}
+        )
+        return success
+
+    def test_admin_revoke_tokens(self):
+        """Test that revoked tokens are rejected (in-memory list when AUTH_STATELESS=true)"""
+        if not self.is_admin:
+            print("⚠️  Skipping admin test - user is not admin")
+            return True
+        if not self.secondary_token and not self.create_secondary_user():
+            return False
+
+        results = [self.secondary_request("Secondary Token Before Revoke", "auth/me", 200)]
+        success, _ = self.run_test(
+            "Revoke Secondary User Tokens",
+            "POST",
+            f"admin/users/{self.secondary_id}/revoke-tokens",
+            200
+        )
+        results.append(success)
+        # Identity-only and DB-backed routes must both reject the revoked token
+        results.append(self.secondary_request("Revoked Token On Identity Route", "auth/me", 401))
+        results.append(self.secondary_request("Revoked Token On Tasks", "tasks", 401))
+        return all(results)
+
+    def test_admin_disable_user(self):
+        """Test that disabling a user blocks their tokens and logins until re-enabled"""
+        if not self.is_admin:
+            print("⚠️  Skipping admin test - user is not admin")
+            return True
+        if not self.secondary_token and not self.create_secondary_user():
+            return False
+
+        # Token iat has one-second resolution: a token issued in the same second
+        # as an earlier revocation would still count as revoked
+        time.sleep(1.1)
+        results = [self.login_secondary_user(), self.secondary_request("Secondary Token Before Disable", "auth/me", 200)]
+        success, _ = self.run_test(
+            "Disable Secondary User",
+            "PUT",
+            f"admin/users/{self.secondary_id}/status",
+            200,
+            data={"is_disabled": True}
+        )
+        results.append(success)
+        results.append(self.secondary_request("Disabled User On Identity Route", "auth/me", 401))
+        results.append(self.login_secondary_user(expected_status=403))
+
+        success, _ = self.run_test(
+            "Re-enable Secondary User",
+            "PUT",
+            f"admin/users/{self.secondary_id}/status",
+            200,
+            data={"is_disabled": False}
+        )
+        results.append(success)
+        time.sleep(1.1)
+        results.append(self.login_secondary_user())
+        results.append(self.secondary_request("Re-enabled User", "auth/me", 200))
+        return all(results)
+
+    def test_admin_profiler(self):
+        """Test profiling one request and downloading its collapsed stacks (single worker)"""
+        if not self.is_admin:
+            print("⚠️  Skipping admin test - user is not admin")
+            return True
+
+        success, response = self.run_test(
+            "Start Profiler",
+            "POST",
+            "admin/profiler",
+            200,
+            data={"requests": 1, "route": "/api/report"}
+        )
+        if not success:
+            return False
+        profile_id = response.get('profile_id')
+        if not self.run_test("Profiled Request", "GET", "report", 200)[0]:
+            return False
+
+        # The profile is saved right after the profiled response is sent
+        profiles = []
+        for _ in range(10):
+            success, profiles = self.run_test("List Profiles", "GET", "admin/profiler/profiles", 200)
+            if success and any(p.get('id') == profile_id for p in profiles):
+                break
+            time.sleep(0.5)
+        else:
+            print(f"❌ Profile {profile_id} not saved")
+            return False
+
+        self.tests_run += 1
+        print("\n🔍 Testing Download Profile...")
+        response = requests.get(
+            f"{self.base_url}/admin/profiler/profiles/{profile_id}",
+            headers={'Authorization': f'Bearer {self.token}'}
+        )
+        if response.status_code != 200 or not response.headers.get('content-type', '').startswith('text/plain'):
+            print(f"❌ Failed - Status: {response.status_code}, type: {response.headers.get('content-type')}")
+            return False
+        self.tests_passed += 1
+        print(f"✅ Passed - {len(response.text.splitlines())} collapsed stacks")
+        return True
+
     def test_delete_task(self):
         """Test task deletion"""
         if not self.task_id:
@@ -321,19 +608,29 @@ def main():
     # Test sequence
     tests = [
         ("Root Endpoint", tester.test_root_endpoint),
+        ("Startup Health", tester.test_startup_health),
         ("Config Status", tester.test_config_status),
         ("User Registration", tester.test_register),
         ("Email Verification", tester.test_verify_email),
         ("Get Current User", tester.test_get_me),
         ("Create Task", tester.test_create_task),
+        ("Idempotent Create Task", tester.test_idempotent_create_task),
         ("Get All Tasks", tester.test_get_tasks),
+        ("Search Tasks", tester.test_search_tasks),
+        ("Task Changes", tester.test_task_changes),
         ("Get Single Task", tester.test_get_single_task),
         ("Update Task", tester.test_update_task),
         ("AI Task Analysis", tester.test_analyze_task),
+        ("Concurrent Analyze Single-Flight", tester.test_concurrent_analyze_single_flight),
         ("AI Analyze All Tasks", tester.test_analyze_all_tasks),
+        ("Similar Tasks", tester.test_similar_tasks),
         ("Get Report", tester.test_get_report),
         ("Admin Get Config", tester.test_admin_get_config),
         ("Admin Update Config", tester.test_admin_update_config),
+        ("Admin Analytics", tester.test_admin_analytics),
+        ("Admin Revoke Tokens", tester.test_admin_revoke_tokens),
+        ("Admin Disable User", tester.test_admin_disable_user),
+        ("Admin Profiler", tester.test_admin_profiler),
         ("Delete Task", tester.test_delete_task),
     ]
     
@@ -1,4 +1,4 @@
-import React, { useState, useEffect } from 'react';
+import React, { useState, useEffect, useRef } from 'react';
 import { Link, useNavigate } from 'react-router-dom';
 import { useAuth } from '../context/AuthContext';
 import axios from 'axios';
@@ -170,10 +170,45 @@ const Dashboard = () => {
         }
     }, []);
 
+    // Last change-feed sequence applied to `tasks` (null = no local state yet)
+    const taskSeq = useRef(null);
+
+    const applyTaskChanges = (current, changes) => {
+        const byId = new Map(current.map(task => [task.id, task]));
+        changes.forEach(change => {
+            if (change.op === 'delete') {
+                byId.delete(change.task_id);
+            } else if (change.task) {
+                byId.set(change.task_id, change.task);
+            }
+        });
+        return Array.from(byId.values());
+    };
+
     const fetchTasks = async () => {
         try {
-            const response = await axios.get(`${API}/tasks`);
-            setTasks(response.data);
+            // Only download what changed since the last sync
+            let feed = (await axios.get(`${API}/tasks/changes`, { params: { since: taskSeq.current ?? undefined } })).data;
+            if (feed.reset) {
+                const response = await axios.get(`${API}/tasks`);
+                setTasks(response.data);
+                taskSeq.current = feed.seq;
+                return;
+            }
+            let changes = feed.changes;
+            while (feed.has_more) {
+                const previousSeq = feed.seq;
+                feed = (await axios.get(`${API}/tasks/changes`, { params: { since: previousSeq } })).data;
+                if (feed.reset) {
+                    taskSeq.current = null;
+                    return fetchTasks();
+                }
+                changes = changes.concat(feed.changes);
+                // Never spin on a page that made no progress; the next poll retries
+                if (feed.seq <= previousSeq) break;
+            }
+            setTasks(current => applyTaskChanges(current, changes));
+            taskSeq.current = feed.seq;
         } catch (error) {
             toast.error('Error al cargar tareas');
         } finally {
@@ -1,10 +1,12 @@
-import React, { useState, useEffect } from 'react';
+import React, { useState, useEffect, useRef } from 'react';
 import { Link } from 'react-router-dom';
 import { useAuth } from '../context/AuthContext';
 import axios from 'axios';
 import { Button } from '../components/ui/button';
 import { Card, CardContent, CardHeader, CardTitle } from '../components/ui/card';
 import { Tabs, TabsContent, TabsList, TabsTrigger } from '../components/ui/tabs';
+import { Input } from '../components/ui/input';
+import { Select, SelectContent, SelectItem, SelectTrigger, SelectValue } from '../components/ui/select';
 import { toast } from 'sonner';
 import { 
     ArrowLeft, 
@@ -14,26 +16,39 @@ import {
     Users, 
     Zap, 
     Trash2,
-    FileSpreadsheet
+    FileSpreadsheet,
+    Search
 } from 'lucide-react';
 import * as XLSX from 'xlsx';
 import { saveAs } from 'file-saver';
 
 const API = `${process.env.REACT_APP_BACKEND_URL}/api`;
 
+const DECISION_CODES = { conservar: 'C', delegar: 'D', automatizar: 'A', eliminar: 'E' };
+
 const Report = () => {
     const { user } = useAuth();
     const [report, setReport] = useState(null);
+    const [tasks, setTasks] = useState([]);
     const [loading, setLoading] = useState(true);
     const [filter, setFilter] = useState('all');
+    const [search, setSearch] = useState('');
+    const [sort, setSort] = useState('created_at');
+    const tasksRequest = useRef(0);
 
     useEffect(() => {
         fetchReport();
     }, []);
 
+    // Filtering, search and sorting happen server-side; debounce typing in the search box
+    useEffect(() => {
+        const timeout = setTimeout(fetchTasks, search ? 300 : 0);
+        return () => clearTimeout(timeout);
+    }, [filter, search, sort]);
+
     const fetchReport = async () => {
         try {
-            const response = await axios.get(`${API}/report`);
+            const response = await axios.get(`${API}/report`, { params: { include_tasks: false } });
             setReport(response.data);
         } catch (error) {
             toast.error('Error al cargar el informe');
@@ -42,10 +57,35 @@ const Report = () => {
         }
     };
 
-    const exportToExcel = () => {
-        if (!report) return;
+    const fetchTasks = async () => {
+        const query = search.trim();
+        const requestId = ++tasksRequest.current;
+        try {
+            const response = await axios.get(`${API}/tasks`, {
+                params: {
+                    decision: DECISION_CODES[filter],
+                    q: query || undefined,
+                    // Relevance ranking only exists for a text search
+                    sort: sort === 'relevance' && !query ? 'created_at' : sort
+                }
+            });
+            // Ignore responses that arrive after a newer filter/search was requested
+            if (requestId === tasksRequest.current) setTasks(response.data);
+        } catch (error) {
+            toast.error('Error al cargar las tareas');
+        }
+    };
 
-        const data = report.tasks.map(task => ({
+    const exportToExcel = async () => {
+        let fullReport;
+        try {
+            fullReport = (await axios.get(`${API}/report`)).data;
+        } catch (error) {
+            toast.error('Error al exportar el informe');
+            return;
+        }
+
+        const data = fullReport.tasks.map(task => ({
             'Tarea': task.name,
             'Descripción': task.description,
             'Frecuencia': task.frequency,
@@ -69,12 +109,12 @@ const Report = () => {
 
         // Add summary sheet
         const summaryData = [
-            { 'Métrica': 'Total de tareas', 'Valor': report.stats.total },
-            { 'Métrica': 'Tareas analizadas', 'Valor': report.stats.analyzed },
-            { 'Métrica': 'Conservar', 'Valor': report.stats.conservar },
-            { 'Métrica': 'Delegar', 'Valor': report.stats.delegar },
-            { 'Métrica': 'Automatizar', 'Valor': report.stats.automatizar },
-            { 'Métrica': 'Eliminar', 'Valor': report.stats.eliminar }
+            { 'Métrica': 'Total de tareas', 'Valor': fullReport.stats.total },
+            { 'Métrica': 'Tareas analizadas', 'Valor': fullReport.stats.analyzed },
+            { 'Métrica': 'Conservar', 'Valor': fullReport.stats.conservar },
+            { 'Métrica': 'Delegar', 'Valor': fullReport.stats.delegar },
+            { 'Métrica': 'Automatizar', 'Valor': fullReport.stats.automatizar },
+            { 'Métrica': 'Eliminar', 'Valor': fullReport.stats.eliminar }
         ];
         const summaryWs = XLSX.utils.json_to_sheet(summaryData);
         XLSX.utils.book_append_sheet(wb, summaryWs, 'Resumen');
@@ -86,13 +126,6 @@ const Report = () => {
         toast.success('Informe exportado exitosamente');
     };
 
-    const getFilteredTasks = () => {
-        if (!report) return [];
-        if (filter === 'all') return report.tasks;
-        const decisionMap = { conservar: 'C', delegar: 'D', automatizar: 'A', eliminar: 'E' };
-        return report.tasks.filter(task => task.decision === decisionMap[filter]);
-    };
-
     const getDecisionBadge = (decision) => {
         const badges = {
             C: { label: 'Conservar', class: 'bg-yellow-100 text-yellow-800 border-yellow-200' },
@@ -116,8 +149,6 @@ const Report = () => {
         );
     }
 
-    const filteredTasks = getFilteredTasks();
-
     return (
         <div className="min-h-screen bg-secondary">
             {/* Header */}
@@ -200,6 +231,32 @@ const Report = () => {
                     <CardHeader>
                         <div className="flex flex-col sm:flex-row justify-between items-start sm:items-center gap-4">
                             <CardTitle className="font-heading">Detalle de Tareas</CardTitle>
+                            <div className="flex flex-col sm:flex-row gap-2 w-full sm:w-auto">
+                                <div className="relative">
+                                    <Search className="absolute left-3 top-1/2 -translate-y-1/2 h-4 w-4 text-muted-foreground" />
+                                    <Input
+                                        value={search}
+                                        onChange={(e) => setSearch(e.target.value)}
+                                        placeholder="Buscar tareas"
+                                        className="pl-9"
+                                        data-testid="report-search-input"
+                                    />
+                                </div>
+                                <Select value={sort} onValueChange={setSort}>
+                                    <SelectTrigger className="sm:w-44" data-testid="report-sort-select">
+                                        <SelectValue />
+                                    </SelectTrigger>
+                                    <SelectContent>
+                                        <SelectItem value="created_at">Más antiguas</SelectItem>
+                                        <SelectItem value="-created_at">Más recientes</SelectItem>
+                                        <SelectItem value="name">Nombre</SelectItem>
+                                        <SelectItem value="-impact">Mayor impacto</SelectItem>
+                                        <SelectItem value="-risk">Mayor riesgo</SelectItem>
+                                        <SelectItem value="effort">Menor esfuerzo</SelectItem>
+                                        <SelectItem value="relevance" disabled={!search.trim()}>Relevancia</SelectItem>
+                                    </SelectContent>
+                                </Select>
+                            </div>
                             <Tabs value={filter} onValueChange={setFilter} className="w-full sm:w-auto">
                                 <TabsList className="grid grid-cols-5 w-full sm:w-auto">
                                     <TabsTrigger value="all" data-testid="filter-all">Todas</TabsTrigger>
@@ -212,7 +269,7 @@ const Report = () => {
                         </div>
                     </CardHeader>
                     <CardContent>
-                        {filteredTasks.length === 0 ? (
+                        {tasks.length === 0 ? (
                             <div className="text-center py-12 text-muted-foreground">
                                 No hay tareas en esta categoría
                             </div>
@@ -230,7 +287,7 @@ const Report = () => {
                                         </tr>
                                     </thead>
                                     <tbody className="divide-y divide-border">
-                                        {filteredTasks.map((task) => {
+                                        {tasks.map((task) => {
                                             const badge = getDecisionBadge(task.decision);
                                             return (
                                                 <tr key={task.id} className="hover:bg-secondary/50 transition-colors">
@@ -0,0 +1,267 @@
+"""Query-plan regression checks for every MongoDB access in backend/server.py.
+
+Drives the API against a seeded local MongoDB with QUERY_CAPTURE enabled,
+then runs `explain` on every captured query shape. Fails when a query does
+a collection scan or examines far more documents than it returns.
+
+Needs a reachable MongoDB (MONGO_URL, default mongodb://localhost:27017);
+skipped otherwise. A throwaway database is created and dropped.
+"""
+import importlib
+import json
+import os
+import random
+import sys
+import uuid
+from pathlib import Path
+
+import pytest
+
+pymongo = pytest.importorskip("pymongo")
+pytest.importorskip("fastapi")
+pytest.importorskip("httpx")
+
+MONGO_URL = os.environ.get("MONGO_URL", "mongodb://localhost:27017")
+DB_NAME = f"query_plans_{uuid.uuid4().hex[:8]}"
+
+# A query may examine this many documents per returned one (or MIN_EXAMINED in total)
+MAX_EXAMINED_RATIO = 10
+MIN_EXAMINED = 25
+
+SEED_OWN_TASKS = 120
+SEED_OTHER_TASKS = 400
+
+FREQUENCIES = ["Diaria", "Semanal", "Mensual", "Ocasional"]
+TASK_NAMES = [
+    "Pagar proveedores", "Conciliación bancaria mensual", "Publicar en redes sociales",
+    "Revisar contratos", "Responder correos de clientes", "Preparar presupuesto",
+    "Liquidar sueldos", "Actualizar inventario", "Prospectar clientes nuevos"
+]
+
+
+def _mongo_available() -> bool:
+    try:
+        pymongo.MongoClient(MONGO_URL, serverSelectionTimeoutMS=1000).admin.command("ping")
+        return True
+    except Exception:
+        return False
+
+
+pytestmark = pytest.mark.skipif(not _mongo_available(), reason="MongoDB no disponible")
+
+
+@pytest.fixture(scope="module")
+def server():
+    # Config is read at import time: import a fresh copy of the module with
+    # query capture on, and restore the environment and sys.modules afterwards
+    with pytest.MonkeyPatch.context() as mp:
+        for name, value in {
+            "MONGO_URL": MONGO_URL,
+            "DB_NAME": DB_NAME,
+            "QUERY_CAPTURE": "true",
+            "STARTUP_WARMUP": "false",
+            "REANALYSIS_BATCH_SIZE": "3",
+            "REANALYSIS_CALL_SPACING_SECONDS": "0",
+            "EMERGENT_LLM_KEY": os.environ.get("EMERGENT_LLM_KEY", "test-key"),
+        }.items():
+            mp.setenv(name, value)
+        mp.syspath_prepend(str(Path(__file__).resolve().parent.parent / "backend"))
+        mp.delitem(sys.modules, "server", raising=False)
+        server_module = importlib.import_module("server")
+        mp.setitem(sys.modules, "server", server_module)
+
+        yield server_module
+
+    pymongo.MongoClient(MONGO_URL).drop_database(DB_NAME)
+
+
+@pytest.fixture(scope="module")
+def api(server):
+    from fastapi.testclient import TestClient
+
+    async def fake_analysis(task):
+        # Stands in for the LLM call; everything around it runs for real
+        return {
+            "impact": 4, "risk": 2, "effort": 3, "confidentiality": "Media", "decision": "D",
+            "decision_justification": "Delegable", "suggested_profile": "Administrativo interno",
+            "suggested_hours": "2-4 hrs/sem", "analyzed_at": server.utcnow(), "reused_from": None,
+            "analysis_version": server.ANALYSIS_VERSION, "needs_reanalysis": False,
+            "llm_usage": {"input_tokens": 1, "output_tokens": 1}
+        }
+
+    server.run_task_analysis = fake_analysis
+    with TestClient(server.app) as client:
+        yield client
+
+
+def _seed_tasks(server, user_id: str, count: int):
+    rng = random.Random(user_id)
+    docs = []
+    for i in range(count):
+        task = server.Task(
+            user_id=user_id,
+            name=f"{rng.choice(TASK_NAMES)} {i}",
+            description=f"Tarea de prueba número {i} para el análisis de planes",
+            frequency=rng.choice(FREQUENCIES),
+            duration="1 hora",
+            impact=rng.randint(1, 5),
+            risk=rng.randint(1, 5),
+            effort=rng.randint(1, 5),
+            confidentiality=rng.choice(["Baja", "Media", "Alta"]),
+            decision=rng.choice(["C", "D", "A", "E", None]),
+        )
+        doc = {**server.new_task_document(task), **server.similarity_fields(task.name, task.description)}
+        if task.decision:
+            doc["analyzed_at"] = server.utcnow()
+        docs.append(doc)
+    pymongo.MongoClient(MONGO_URL, tz_aware=True)[DB_NAME].tasks.insert_many(docs)
+
+
+def _drive_api(server, api, monkeypatch):
+    """Hit every endpoint and background job that touches MongoDB"""
+    register = api.post("/api/auth/register", json={"email": "owner@example.com"})
+    assert register.status_code == 200, register.text
+    token = register.json()["verification_link"].split("token=")[1]
+    verified = api.post("/api/auth/verify-email", json={"token": token, "password": "Secreta123!"})
+    assert verified.status_code == 200, verified.text
+    user_id = verified.json()["user"]["id"]
+    headers = {"Authorization": f"Bearer {verified.json()['token']}"}
+
+    api.post("/api/auth/register", json={"email": "owner@example.com"})  # duplicate
+    assert api.post("/api/auth/login", json={"email": "owner@example.com", "password": "Secreta123!"}).status_code == 200
+
+    _seed_tasks(server, user_id, SEED_OWN_TASKS)
+    for i in range(5):
+        _seed_tasks(server, f"other-user-{i}", SEED_OTHER_TASKS // 5)
+
+    get = lambda path: api.get(f"/api/{path}", headers=headers)
+    created = api.post("/api/tasks", headers={**headers, "Idempotency-Key": "k1"}, json={
+        "name": "Pago a proveedores", "description": "Pagar facturas de proveedores",
+        "frequency": "Mensual", "duration": "2 horas"
+    }).json()
+    retried = api.post("/api/tasks", headers={**headers, "Idempotency-Key": "k1"}, json={
+        "name": "Pago a proveedores", "description": "Pagar facturas de proveedores",
+        "frequency": "Mensual", "duration": "2 horas"
+    })
+    assert retried.status_code == 200 and retried.json()["id"] == created["id"], retried.text
+    task_id = created["id"]
+
+    for path in (
+        "auth/me", "config/status", "config", "tasks",
+        "tasks?decision=D&sort=-created_at", "tasks?decision=C,A", "tasks?frequency=Mensual",
+        "tasks?confidentiality=Alta", "tasks?min_impact=3&max_risk=4", "tasks?analyzed=true",
+        "tasks?q=proveedores", "tasks?q=proveedores&sort=relevance",
+        "tasks/changes", "tasks/changes?since=0", f"tasks/{task_id}", f"tasks/{task_id}/similar",
+        f"tasks/{task_id}/history", "report", "report?include_tasks=false", "admin/analytics", "admin/reanalysis",
+        "admin/profiler/profiles", "health/startup",
+    ):
+        response = get(path)
+        assert response.status_code == 200, f"{path}: {response.text}"
+
+    with monkeypatch.context() as mp:
+        mp.setattr(server, "SIMILARITY_SCOPE", "global")
+        assert get(f"tasks/{task_id}/similar").status_code == 200
+
+    assert api.put(f"/api/tasks/{task_id}", headers=headers, json={"description": "Pagar a todos los proveedores"}).status_code == 200
+    assert api.post(f"/api/tasks/{task_id}/analyze?reuse=false", headers=headers).status_code == 200
+    assert api.post(f"/api/tasks/{task_id}/analyze", headers={**headers, "Idempotency-Key": "k2"}).status_code == 200
+
+    # Background re-analysis: an edited task first, then outdated seeded ones
+    assert api.put(f"/api/tasks/{task_id}", headers=headers, json={"duration": "3 horas"}).status_code == 200
+    assert api.portal.call(server.run_reanalysis_batch) > 0
+
+    other = api.post("/api/auth/register", json={"email": "other@example.com"})
+    assert other.status_code == 200, other.text
+    other_id = other.json()["user_id"]
+    for disabled in (True, False):
+        response = api.put(f"/api/admin/users/{other_id}/status", headers=headers, json={"is_disabled": disabled})
+        assert response.status_code == 200, response.text
+    assert api.put("/api/config", headers=headers, json={"app_name": "SmartTasks"}).status_code == 200
+    assert api.post("/api/admin/analytics/rebuild", headers=headers, json={"days": 7}).status_code == 200
+    assert api.delete(f"/api/tasks/{task_id}", headers=headers).status_code == 200
+    assert api.post(f"/api/admin/users/{user_id}/revoke-tokens", headers=headers).status_code == 200
+    assert get("auth/me").status_code == 401
+
+
+def _shape(value):
+    if isinstance(value, dict):
+        return {k: _shape(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_shape(value[0])] if value else []
+    return type(value).__name__
+
+
+def _plan_stages(explain: dict) -> set:
+    """Stage names of the winning plan / executed stages (rejected plans ignored)"""
+    stages = set()
+
+    def collect(node):
+        if isinstance(node, dict):
+            if "stage" in node:
+                stages.add(node["stage"])
+            for key, child in node.items():
+                if key != "rejectedPlans":
+                    collect(child)
+        elif isinstance(node, list):
+            for child in node:
+                collect(child)
+
+    def find_plans(node):
+        if isinstance(node, dict):
+            for key, child in node.items():
+                if key in ("winningPlan", "executionStages"):
+                    collect(child)
+                elif key != "rejectedPlans":
+                    find_plans(child)
+        elif isinstance(node, list):
+            for child in node:
+                find_plans(child)
+
+    find_plans(explain)
+    return stages
+
+
+def _explain(database, query: dict) -> dict:
+    if query["operation"] == "aggregate":
+        return database.command("explain", {
+            "aggregate": query["collection"], "pipeline": query["filter"], "cursor": {}
+        }, verbosity="executionStats")
+    command = {"find": query["collection"], "filter": query["filter"]}
+    if query["sort"]:
+        command["sort"] = dict(query["sort"]) if isinstance(query["sort"], list) else query["sort"]
+    if isinstance(query["projection"], dict):
+        command["projection"] = query["projection"]
+    if query["operation"] in ("find_one", "find_one_and_update", "update_one", "delete_one"):
+        command["limit"] = 1
+    return database.command("explain", command, verbosity="executionStats")
+
+
+def test_every_query_uses_an_index(server, api, monkeypatch):
+    server.captured_queries.clear()
+    _drive_api(server, api, monkeypatch)
+
+    shapes = {}
+    for query in server.captured_queries:
+        key = json.dumps(
+            [query["collection"], query["operation"], _shape(query["filter"]), _shape(query["sort"])],
+            sort_keys=True, default=str
+        )
+        shapes.setdefault(key, query)
+    assert shapes, "No se capturó ninguna consulta"
+
+    database = pymongo.MongoClient(MONGO_URL, tz_aware=True)[DB_NAME]
+    problems = []
+    for key, query in shapes.items():
+        explain = _explain(database, query)
+        stages = _plan_stages(explain)
+        # Unfiltered reads (e.g. the first-admin probe) are limit-1 or read everything on purpose
+        if "COLLSCAN" in stages and query["filter"]:
+            problems.append(f"COLLSCAN: {key}")
+            continue
+        stats = explain.get("executionStats")
+        if query["operation"] != "aggregate" and stats:
+            examined, returned = stats["totalDocsExamined"], stats["nReturned"]
+            if examined > max(MAX_EXAMINED_RATIO * returned, MIN_EXAMINED):
+                problems.append(f"{examined} docs examinados para {returned} devueltos: {key}")
+
+    assert not problems, "Planes de consulta con regresiones:\n" + "\n".join(problems)